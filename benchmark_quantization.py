@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Vector Storage Benchmark
+Estimates the kNN graph memory and recall@k of the float, fp16 and byte
+storage profiles used by lambda_embed. Recall is measured by exact search in
+the quantized space against exact float32 search, so it isolates the loss
+from quantization (HNSW approximation comes on top of it in every profile).
+"""
+
+import argparse
+import math
+import operator
+import os
+import random
+import struct
+
+# Bytes per stored vector component for each storage profile
+BYTES_PER_COMPONENT = {
+    'float': 4,
+    'fp16': 2,
+    'byte': 1
+}
+
+def normalize(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+def synthetic_vectors(count, dimension, clusters, noise, rng):
+    """Generate normalized vectors grouped around random centroids"""
+    centroids = [normalize([rng.gauss(0, 1) for _ in range(dimension)]) for _ in range(clusters)]
+    vectors = []
+    for _ in range(count):
+        centroid = rng.choice(centroids)
+        vectors.append(normalize([c + rng.gauss(0, noise / math.sqrt(dimension)) for c in centroid]))
+    return vectors
+
+def index_vectors(index_name, count):
+    """Read stored float vectors from an existing OpenSearch index. An index
+    built with the byte profile stores already-quantized vectors, which are
+    no float32 ground truth, so it is refused."""
+    from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
+
+    opensearch = OpenSearch(
+        hosts=[{'host': os.environ['OPENSEARCH_ENDPOINT'], 'port': 443}],
+        http_auth=('admin', 'Admin@123456'),
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection
+    )
+    mapping = next(iter(opensearch.indices.get_mapping(index=index_name).values()))['mappings']
+    data_type = mapping['properties']['embedding'].get('data_type', 'float')
+    if data_type != 'float':
+        raise SystemExit(f"{index_name} stores {data_type} vectors; benchmark an index built with "
+                         f"VECTOR_STORAGE=float or fp16, or use --source synthetic")
+
+    # The embedding is excluded from _source, so it is read from doc values
+    query = {
+        'query': {'match_all': {}},
+        '_source': False,
+        'script_fields': {
+            'embedding': {'script': {'lang': 'painless', 'source': "doc['embedding'].value"}}
+        }
+    }
+    vectors = []
+    for hit in helpers.scan(opensearch, index=index_name, query=query):
+        values = hit['fields']['embedding']
+        vectors.append(values[0] if isinstance(values[0], list) else values)
+        if len(vectors) >= count:
+            break
+    return vectors
+
+def to_fp16(vector):
+    return list(struct.unpack(f'{len(vector)}e', struct.pack(f'{len(vector)}e', *vector)))
+
+def to_bytes(vector, value_range):
+    scale = 127 / value_range
+    return [max(-128, min(127, round(x * scale))) for x in vector]
+
+def quantize(vector, profile, value_range):
+    if profile == 'fp16':
+        return to_fp16(vector)
+    if profile == 'byte':
+        return to_bytes(vector, value_range)
+    return vector
+
+def top_k(query, vectors, k):
+    """Exact inner-product search; for normalized vectors this matches l2 order"""
+    scores = [(sum(map(operator.mul, query, v)), i) for i, v in enumerate(vectors)]
+    scores.sort(reverse=True)
+    return [i for _, i in scores[:k]]
+
+def graph_memory_bytes(profile, count, dimension, m):
+    """Native memory estimate for an HNSW graph: 1.1 * (bytes * d + 8 * m) * n"""
+    return 1.1 * (BYTES_PER_COMPONENT[profile] * dimension + 8 * m) * count
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vector storage profiles')
+    parser.add_argument('--source', choices=['synthetic', 'index'], default='synthetic',
+                        help='Use synthetic vectors or read them from an OpenSearch index')
+    parser.add_argument('--index', default=os.environ.get('INDEX_NAME', 'document_embeddings'), help='Index to read vectors from')
+    parser.add_argument('--count', type=int, default=2000, help='Number of corpus vectors')
+    parser.add_argument('--queries', type=int, default=50, help='Number of query vectors')
+    parser.add_argument('--dimension', type=int, default=1024, help='Dimension of synthetic vectors')
+    parser.add_argument('--clusters', type=int, default=50, help='Clusters in the synthetic corpus')
+    parser.add_argument('--noise', type=float, default=1.0, help='Spread of synthetic vectors around their cluster')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours per query for recall@k')
+    parser.add_argument('--m', type=int, default=16, help='HNSW m used for the memory estimate')
+    parser.add_argument('--byte-range', type=float, default=float(os.environ.get('BYTE_QUANTIZATION_RANGE', '0.25')),
+                        help='Clipping range of the byte quantizer (BYTE_QUANTIZATION_RANGE)')
+    parser.add_argument('--projected-count', type=int, default=1000000, help='Corpus size for the projected memory column')
+    parser.add_argument('--seed', type=int, default=7, help='Random seed')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.source == 'index':
+        vectors = index_vectors(args.index, args.count + args.queries)
+        rng.shuffle(vectors)
+        queries, corpus = vectors[:args.queries], vectors[args.queries:]
+    else:
+        vectors = synthetic_vectors(args.count + args.queries, args.dimension, args.clusters, args.noise, rng)
+        queries, corpus = vectors[:args.queries], vectors[args.queries:]
+    dimension = len(corpus[0])
+
+    print(f"Corpus: {len(corpus)} vectors of dimension {dimension}, {len(queries)} queries, k={args.k}")
+    exact = [set(top_k(q, corpus, args.k)) for q in queries]
+
+    print(f"\n{'profile':<8} {'recall@k':>9} {'graph MB':>10} {'MB @ ' + str(args.projected_count):>16} {'vs float':>9}")
+    float_memory = graph_memory_bytes('float', args.projected_count, dimension, args.m)
+    for profile in ('float', 'fp16', 'byte'):
+        stored = [quantize(v, profile, args.byte_range) for v in corpus]
+        hits = 0
+        for query, expected in zip(queries, exact):
+            hits += len(expected & set(top_k(quantize(query, profile, args.byte_range), stored, args.k)))
+        recall = hits / (len(queries) * args.k)
+        memory = graph_memory_bytes(profile, len(corpus), dimension, args.m)
+        projected = graph_memory_bytes(profile, args.projected_count, dimension, args.m)
+        print(f"{profile:<8} {recall:>9.4f} {memory / 2**20:>10.1f} {projected / 2**20:>16.0f} {projected / float_memory:>8.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -4,17 +4,102 @@ import os
 import PyPDF2
 import io
 import re
-from opensearchpy import OpenSearch, RequestsHttpConnection
+import mmap
+import multiprocessing
+import queue
+import random
+import hashlib
+import itertools
+import shutil
+import tempfile
+import uuid
+import zlib
+from urllib.parse import unquote_plus
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
+from opensearchpy.exceptions import ConflictError, NotFoundError, RequestError
 from requests_aws4auth import AWS4Auth
 
+# Embedding model configuration
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"  # Updated model ID
+# Titan Text Embeddings V2 returns normalized vectors of 256, 512 or 1024
+# dimensions; the index mapping is created with the same dimension
+EMBEDDING_DIMENSION = int(os.environ.get('EMBEDDING_DIMENSION', '1024'))
+if EMBEDDING_DIMENSION not in (256, 512, 1024):
+    raise ValueError(f"Unsupported EMBEDDING_DIMENSION {EMBEDDING_DIMENSION}; use 256, 512 or 1024")
+
+# Vector storage profile for the knn_vector field: 'float' (float32),
+# 'fp16' (faiss HNSW with SQfp16 encoding) or 'byte' (signed 8-bit values,
+# scalar-quantized client-side from the normalized Titan output). fp16 and
+# byte (with the default innerproduct space) need OpenSearch 2.13 or later.
+VECTOR_STORAGE = os.environ.get('VECTOR_STORAGE', 'float')
+if VECTOR_STORAGE not in ('float', 'fp16', 'byte'):
+    raise ValueError(f"Unsupported VECTOR_STORAGE {VECTOR_STORAGE}; use float, fp16 or byte")
+# Components of normalized vectors beyond +/- this range are clipped when
+# quantizing to bytes
+BYTE_QUANTIZATION_RANGE = float(os.environ.get('BYTE_QUANTIZATION_RANGE', '0.25'))
+
+# HNSW index profile applied when the index is created. Titan vectors are
+# normalized, so inner product ranks the same as cosine similarity. fp16
+# storage needs the faiss engine and byte storage the lucene engine.
+DEFAULT_KNN_ENGINES = {'float': 'nmslib', 'fp16': 'faiss', 'byte': 'lucene'}
+KNN_ENGINE = os.environ.get('KNN_ENGINE', DEFAULT_KNN_ENGINES[VECTOR_STORAGE])
+KNN_SPACE_TYPE = os.environ.get('KNN_SPACE_TYPE', 'innerproduct')
+HNSW_M = int(os.environ.get('HNSW_M', '16'))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('HNSW_EF_CONSTRUCTION', '100'))
+KNN_EF_SEARCH = int(os.environ.get('KNN_EF_SEARCH', '100'))
+if KNN_ENGINE not in ('nmslib', 'faiss', 'lucene'):
+    raise ValueError(f"Unsupported KNN_ENGINE {KNN_ENGINE}; use nmslib, faiss or lucene")
+if VECTOR_STORAGE != 'float' and KNN_ENGINE != DEFAULT_KNN_ENGINES[VECTOR_STORAGE]:
+    raise ValueError(f"VECTOR_STORAGE {VECTOR_STORAGE} requires KNN_ENGINE {DEFAULT_KNN_ENGINES[VECTOR_STORAGE]}")
+
+# Embedding concurrency configuration
+EMBED_INITIAL_CONCURRENCY = int(os.environ.get('EMBED_INITIAL_CONCURRENCY', '4'))
+EMBED_MAX_CONCURRENCY = int(os.environ.get('EMBED_MAX_CONCURRENCY', '16'))
+EMBED_MAX_RETRIES = int(os.environ.get('EMBED_MAX_RETRIES', '6'))
+EMBED_BASE_BACKOFF = float(os.environ.get('EMBED_BASE_BACKOFF', '0.25'))
+EMBED_MAX_BACKOFF = float(os.environ.get('EMBED_MAX_BACKOFF', '8'))
+
+# Bedrock error codes that signal the service is overloaded
+CONGESTION_ERROR_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException'
+}
+
 # Initialize clients
 s3 = boto3.client('s3')
-bedrock_runtime = boto3.client('bedrock-runtime')
+lambda_client = boto3.client('lambda')
+# Size the connection pool for the embedding threads and let the AIMD
+# controller, not botocore, decide how to retry throttled calls
+bedrock_runtime = boto3.client(
+    'bedrock-runtime',
+    config=Config(
+        max_pool_connections=EMBED_MAX_CONCURRENCY,
+        retries={'max_attempts': 1, 'mode': 'standard'}
+    )
+)
 region = os.environ['REGION']  # Changed from AWS_REGION to REGION
 
 # OpenSearch configuration
 host = os.environ['OPENSEARCH_ENDPOINT']
-index_name = 'document_embeddings'
+# INDEX_NAME is the read alias queried by lambda_query; ingestion writes
+# through a separate write alias. Both point at a versioned physical index
+# (<INDEX_NAME>_v<n>), so rag_admin.py reindex can build a replacement and
+# move the aliases onto it atomically.
+index_name = os.environ.get('INDEX_NAME', 'document_embeddings')
+write_alias = os.environ.get('INDEX_WRITE_ALIAS', f"{index_name}_write")
+INDEX_TEMPLATE_NAME = 'document_embeddings_template'
+INDEX_TEMPLATE_VERSION = 5
 credentials = boto3.Session().get_credentials()
 awsauth = AWS4Auth(credentials.access_key, credentials.secret_key,
                   region, 'es', session_token=credentials.token)
@@ -28,138 +113,1684 @@ opensearch = OpenSearch(
     connection_class=RequestsHttpConnection
 )
 
-# Create index if it doesn't exist
-def create_index_if_not_exists():
-    if not opensearch.indices.exists(index=index_name):
-        index_body = {
-            'settings': {
-                'index': {
-                    'knn': True,
-                }
+# Parallel PDF extraction configuration. Lambda lacks /dev/shm, so workers are
+# plain processes fed through pipes rather than a multiprocessing Pool.
+PDF_EXTRACT_WORKERS = int(os.environ.get('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', '32'))
+PDF_PAGES_PER_MESSAGE = 8
+# Messages buffered per worker ahead of the consumer. A full queue stops the
+# pipe from being drained, which blocks the worker's next send, so at most
+# about this many messages of text per worker are held in memory.
+PDF_QUEUED_MESSAGES = 4
+
+# Content-defined chunking. A chunk ends after a word where the crc32 of the
+# last CHUNK_HASH_WINDOW words is a multiple of CHUNK_CUT_DIVISOR, once it has
+# CHUNK_MIN_WORDS new words (and always at CHUNK_MAX_WORDS), and starts with
+# the last CHUNK_OVERLAP_WORDS of the previous chunk. Boundaries depend only on
+# the words around them, so an edit changes the chunks near it while later
+# chunks keep their text, and with it their fingerprints. Chunks average about
+# CHUNK_MIN_WORDS + CHUNK_CUT_DIVISOR new words.
+CHUNK_MIN_WORDS = 200
+CHUNK_MAX_WORDS = 600
+CHUNK_CUT_DIVISOR = 200
+CHUNK_OVERLAP_WORDS = 100
+CHUNK_HASH_WINDOW = 4
+
+# Fan-out ingestion configuration. Workers are dispatched as asynchronous
+# Lambda invocations ('lambda') or run on local threads ('local'), and report
+# completion to an S3 prefix ('s3') or a local directory ('file').
+DOCUMENT_BUCKET = os.environ.get('DOCUMENT_BUCKET', 'rag-document-store-ninad-test')
+INGEST_DISPATCH = os.environ.get('INGEST_DISPATCH', 'lambda')
+INGEST_TRACKER = os.environ.get('INGEST_TRACKER', 's3')
+INGEST_TRACKER_PREFIX = os.environ.get('INGEST_TRACKER_PREFIX', 'ingest-runs/')
+INGEST_TRACKER_DIR = os.environ.get('INGEST_TRACKER_DIR', '/tmp/ingest-runs')
+EMBED_FUNCTION_NAME = os.environ.get('EMBED_FUNCTION_NAME')
+
+# Checkpoint configuration. When less than CHECKPOINT_RESERVE_MS of the
+# invocation remains, ingestion stops, persists its progress to the store
+# ('s3' or 'file') and either re-invokes itself ('invoke') or returns a
+# continuation token ('return').
+CHECKPOINT_STORE = os.environ.get('CHECKPOINT_STORE', 's3')
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', 'checkpoints/')
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', '/tmp/checkpoints')
+CHECKPOINT_RESERVE_MS = int(os.environ.get('CHECKPOINT_RESERVE_MS', '45000'))
+CHECKPOINT_CONTINUE = os.environ.get('CHECKPOINT_CONTINUE', 'invoke')
+
+# Moved chunks whose stored vectors are read back per request
+RELOCATE_BATCH_SIZE = 100
+
+# Script field that reads the stored vector from doc values, since the
+# embedding is excluded from _source
+EMBEDDING_SCRIPT_FIELDS = {
+    'embedding': {
+        'script': {
+            'lang': 'painless',
+            'source': "doc['embedding'].size() == 0 ? null : doc['embedding'].value"
+        }
+    }
+}
+
+# Maximum number of documents from one S3 notification processed at once
+DOCUMENT_CONCURRENCY = int(os.environ.get('DOCUMENT_CONCURRENCY', '4'))
+
+# Bulk indexing configuration. Each embedding serializes to roughly 30 KB of
+# JSON, so batches are bounded by bytes rather than by document count alone.
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', '500'))
+BULK_MAX_CHUNK_BYTES = int(os.environ.get('BULK_MAX_CHUNK_BYTES', str(5 * 1024 * 1024)))
+BULK_THREAD_COUNT = int(os.environ.get('BULK_THREAD_COUNT', '1'))
+BULK_MAX_RETRIES = int(os.environ.get('BULK_MAX_RETRIES', '3'))
+
+# Reindex configuration: parallel scroll slices, and hits per scroll page
+REINDEX_SLICES = int(os.environ.get('REINDEX_SLICES', '4'))
+REINDEX_SCROLL_SIZE = int(os.environ.get('REINDEX_SCROLL_SIZE', '500'))
+
+# Ingestion session configuration. Large loads (fan-out runs, and S3 batches
+# of at least INGEST_SESSION_MIN_RECORDS documents) suspend refresh and
+# replicas, then restore them, optionally force-merge to
+# INGEST_FORCE_MERGE_SEGMENTS segments per shard (0 disables) and preload the
+# kNN graphs so the first query does not pay the graph-load cost.
+INGEST_SESSION_MIN_RECORDS = int(os.environ.get('INGEST_SESSION_MIN_RECORDS', '10'))
+INGEST_FORCE_MERGE_SEGMENTS = int(os.environ.get('INGEST_FORCE_MERGE_SEGMENTS', '0'))
+INGEST_KNN_WARMUP = os.environ.get('INGEST_KNN_WARMUP', 'true').lower() == 'true'
+INGEST_MAINTENANCE_TIMEOUT = int(os.environ.get('INGEST_MAINTENANCE_TIMEOUT', '600'))
+# A session left open longer than INGEST_SESSION_LEASE seconds, by a crashed
+# coordinator or a lost worker, is treated as abandoned and closed by the next
+# session begin or the next cold start of this Lambda
+INGEST_SESSION_LEASE = int(os.environ.get('INGEST_SESSION_LEASE', '3600'))
+
+# Oldest OpenSearch version whose k-NN plugin can build the configured field:
+# lucene byte vectors arrived in 2.9, the faiss SQfp16 encoder and lucene
+# inner product in 2.13
+def required_cluster_version():
+    required = (1, 0)
+    if VECTOR_STORAGE == 'byte':
+        required = (2, 9)
+    if VECTOR_STORAGE == 'fp16' or (KNN_ENGINE == 'lucene' and KNN_SPACE_TYPE == 'innerproduct'):
+        required = (2, 13)
+    return required
+
+# Fail with a clear error, before an index or template is created, when the
+# cluster is too old for the configured storage profile
+def check_cluster_version():
+    required = required_cluster_version()
+    number = opensearch.info()['version']['number']
+    version = tuple(int(part) for part in re.findall(r'\d+', number)[:2])
+    if version < required:
+        raise RuntimeError(
+            f"VECTOR_STORAGE {VECTOR_STORAGE} with the {KNN_ENGINE} engine and {KNN_SPACE_TYPE} space needs "
+            f"OpenSearch {required[0]}.{required[1]} or later, but the cluster runs {number}"
+        )
+
+# knn_vector field definition for the configured storage and HNSW profile
+def build_embedding_field():
+    method = {
+        'name': 'hnsw',
+        'engine': KNN_ENGINE,
+        'space_type': KNN_SPACE_TYPE,
+        'parameters': {
+            'm': HNSW_M,
+            'ef_construction': HNSW_EF_CONSTRUCTION
+        }
+    }
+    field = {
+        'type': 'knn_vector',
+        'dimension': EMBEDDING_DIMENSION,
+        'method': method
+    }
+    if VECTOR_STORAGE == 'fp16':
+        method['parameters']['encoder'] = {'name': 'sq', 'parameters': {'type': 'fp16'}}
+    elif VECTOR_STORAGE == 'byte':
+        field['data_type'] = 'byte'
+    return field
+
+# Settings and mappings for the embeddings index, shared by direct index
+# creation and the index template applied through rag_admin.py
+def build_index_body():
+    index_settings = {
+        'knn': True,
+    }
+    # The lucene engine takes ef_search from each query instead
+    if KNN_ENGINE != 'lucene':
+        index_settings['knn.algo_param.ef_search'] = KNN_EF_SEARCH
+    return {
+        'settings': {
+            'index': index_settings
+        },
+        'mappings': {
+            # Vectors live in the kNN graph and doc values; keeping them out of
+            # _source roughly halves disk use and keeps search payloads small
+            '_source': {
+                'excludes': ['embedding']
             },
-            'mappings': {
-                'properties': {
-                    'embedding': {
-                        'type': 'knn_vector',
-                        'dimension': 1536  # Adjust based on your embedding model
-                    },
-                    'text': {'type': 'text'},
-                    'document_id': {'type': 'keyword'},
-                    'chunk_id': {'type': 'keyword'},
-                    'metadata': {'type': 'object'}
-                }
+            'properties': {
+                'embedding': build_embedding_field(),
+                'text': {'type': 'text'},
+                'document_id': {'type': 'keyword'},
+                'chunk_id': {'type': 'keyword'},
+                'chunk_hash': {'type': 'keyword'},
+                'ingest_run': {'type': 'keyword'},
+                'metadata': {'type': 'object'}
             }
         }
-        opensearch.indices.create(index=index_name, body=index_body)
+    }
+
+# Put the versioned index template so any index matching the name pattern,
+# including one auto-created by a bulk write, gets the kNN mapping. Skipped
+# when the cluster already has this version or a newer one.
+def put_index_template(force=False):
+    current_version = None
+    try:
+        response = opensearch.indices.get_index_template(name=INDEX_TEMPLATE_NAME)
+        current_version = response['index_templates'][0]['index_template'].get('version')
+    except NotFoundError:
+        pass
+
+    if not force and current_version is not None and current_version >= INDEX_TEMPLATE_VERSION:
+        print(f"Index template {INDEX_TEMPLATE_NAME} is already at version {current_version}")
+        return False
+
+    check_cluster_version()
+    opensearch.indices.put_index_template(
+        name=INDEX_TEMPLATE_NAME,
+        body={
+            'index_patterns': [f"{index_name}*"],
+            'version': INDEX_TEMPLATE_VERSION,
+            'priority': 100,
+            'template': build_index_body()
+        }
+    )
+    print(f"Applied index template {INDEX_TEMPLATE_NAME} version {INDEX_TEMPLATE_VERSION}")
+    return True
+
+# Physical index name for a version number
+def versioned_index_name(version):
+    return f"{index_name}_v{version}"
+
+# Concrete indices an index or alias name resolves to, or [] if none
+def resolve_index(name):
+    try:
+        return sorted(opensearch.indices.get_alias(index=name))
+    except NotFoundError:
+        return []
+
+# Create the first versioned index behind the read and write aliases if the
+# write alias doesn't exist. An index created before aliases were introduced
+# keeps serving under its own name and gets the write alias added. The result
+# is memoized for the life of the container, and creation tolerates a
+# concurrent creator winning the race.
+_index_ready = False
+_index_lock = threading.Lock()
 
-# Extract text from PDF
-def extract_text_from_pdf(file_content):
+def create_index_if_not_exists():
+    global _index_ready
+    if _index_ready:
+        return
+
+    with _index_lock:
+        if _index_ready:
+            return
+        if not resolve_index(write_alias):
+            current = resolve_index(index_name)
+            try:
+                if current:
+                    opensearch.indices.put_alias(index=current[-1], name=write_alias)
+                    print(f"Added write alias {write_alias} to {current[-1]}")
+                else:
+                    check_cluster_version()
+                    body = build_index_body()
+                    body['aliases'] = {index_name: {}, write_alias: {}}
+                    opensearch.indices.create(index=versioned_index_name(1), body=body)
+                    print(f"Created index {versioned_index_name(1)} behind aliases {index_name} and {write_alias}")
+            except RequestError as e:
+                if e.error != 'resource_already_exists_exception':
+                    raise
+        # Restore an index left suspended by a session that was never closed
+        try:
+            close_expired_ingestion_session()
+        except Exception as e:
+            print(f"Could not check for an expired ingestion session: {str(e)}")
+        _index_ready = True
+
+# Create the next versioned index, without aliases, and return its name
+def create_versioned_index():
+    versions = [0]
+    for name in opensearch.indices.get_alias(index=f"{index_name}_v*"):
+        suffix = name[len(index_name) + 2:]
+        if suffix.isdigit():
+            versions.append(int(suffix))
+    target_index = versioned_index_name(max(versions) + 1)
+    check_cluster_version()
+    opensearch.indices.create(index=target_index, body=build_index_body())
+    print(f"Created index {target_index}")
+    return target_index
+
+# Point the read and write aliases at target_index in one atomic update and
+# return the indices the read alias pointed at before. An index that holds
+# the read alias's name is deleted in the same update, because the alias
+# cannot be created while it exists; replace_legacy must be set to allow it.
+def swap_aliases(target_index, replace_legacy=False):
+    previous = resolve_index(index_name)
+    actions = []
+    if index_name in previous:
+        if not replace_legacy:
+            raise ValueError(f"{index_name} is an index, not an alias; replacing it deletes it")
+        actions.append({'remove_index': {'index': index_name}})
+    for alias in (index_name, write_alias):
+        for current in resolve_index(alias):
+            if current not in (index_name, target_index):
+                actions.append({'remove': {'index': current, 'alias': alias}})
+        actions.append({'add': {'index': target_index, 'alias': alias}})
+    opensearch.indices.update_aliases(body={'actions': actions})
+    print(f"Aliases {index_name} and {write_alias} now point at {target_index} (previously {previous})")
+    return previous
+
+# Index settings suspended for the duration of an ingestion session
+INGEST_SESSION_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+# Ingestion sessions are recorded as one document per index in this index.
+# Opening a session creates the document with op_type=create, so of two
+# callers racing to open one exactly one wins, and closing deletes it only at
+# the version that was read. The name must not match the index template.
+INGEST_SESSION_INDEX = os.environ.get('INGEST_SESSION_INDEX', f"ingest_sessions_{index_name}")
+
+# Sessions are keyed by concrete index, so a session opened through an alias
+# is found through the index name and the other way round
+def ingestion_session_key(index):
+    concrete = resolve_index(index)
+    return concrete[-1] if concrete else index
+
+# Read the open ingestion session on an index, if any, and the session
+# record's ID and version for a conditional delete
+def get_ingestion_session(index=None):
+    key = ingestion_session_key(index or write_alias)
+    try:
+        response = opensearch.get(index=INGEST_SESSION_INDEX, id=key)
+    except NotFoundError:
+        return None, {'id': key}
+    return response['_source'], {
+        'id': key,
+        'if_seq_no': response['_seq_no'],
+        'if_primary_term': response['_primary_term']
+    }
+
+# Whether a session has outlived its lease
+def ingestion_session_expired(session):
+    return session['expires_at'] <= time.time()
+
+# Close the open ingestion session if it has outlived its lease, restoring
+# the index settings without a force-merge. Returns True if one was closed.
+def close_expired_ingestion_session(index=None):
+    index = index or write_alias
+    session, _ = get_ingestion_session(index)
+    if not session or not ingestion_session_expired(session):
+        return False
+    print(f"Ingestion session on {index} (owner {session.get('owner')}) outlived its lease; closing it")
+    return end_ingestion_session(index, force_merge_segments=0) is not None
+
+# Suspend refresh and replicas for a bulk load. The settings to restore are
+# kept in the session record, so any process can end the session, and a
+# session started while another is open leaves restoring to its owner. An
+# open session that has outlived its lease is closed first. owner identifies
+# the session to end_ingestion_session. Returns True if this call opened the
+# session.
+def begin_ingestion_session(index=None, owner=None):
+    index = index or write_alias
+    close_expired_ingestion_session(index)
+
+    response = opensearch.indices.get_settings(index=index, flat_settings=True)
+    key, settings = next(iter(response.items()))
+    settings = settings['settings']
+    # Unset settings are restored as null, which resets them to the default.
+    # So are settings still suspended by a session that closed after they were
+    # read, since those are never the values to go back to.
+    previous = {}
+    for name, suspended in INGEST_SESSION_SETTINGS.items():
+        value = settings.get(f"index.{name}")
+        previous[name] = None if value == str(suspended) else value
+    started_at = time.time()
+    try:
+        opensearch.index(index=INGEST_SESSION_INDEX, id=key, op_type='create', body={
+            'index': key,
+            'previous': previous,
+            'started_at': started_at,
+            'expires_at': started_at + INGEST_SESSION_LEASE,
+            'owner': owner
+        })
+    except ConflictError:
+        session, _ = get_ingestion_session(index)
+        print(f"Ingestion session on {index} already open (owner {(session or {}).get('owner')})")
+        return False
+    opensearch.indices.put_settings(index=index, body={'index': INGEST_SESSION_SETTINGS})
+    print(f"Opened ingestion session on {index}: suspended refresh and replicas (previously {previous}) "
+          f"for at most {INGEST_SESSION_LEASE}s")
+    return True
+
+# Close the open ingestion session: refresh, optionally force-merge while the
+# index has no replicas to copy the merge to, restore the saved settings and
+# warm the kNN graphs. With owner set, a session opened by someone else is
+# left open.
+def end_ingestion_session(index=None, force_merge_segments=None, warmup=None, owner=None):
+    index = index or write_alias
+    force_merge_segments = INGEST_FORCE_MERGE_SEGMENTS if force_merge_segments is None else force_merge_segments
+    warmup = INGEST_KNN_WARMUP if warmup is None else warmup
+    session, record = get_ingestion_session(index)
+    if not session:
+        print(f"No ingestion session open on {index}")
+        return None
+    if owner and session.get('owner') != owner:
+        print(f"Ingestion session on {index} belongs to {session.get('owner')}, not {owner}; leaving it open")
+        return None
+
+    opensearch.indices.refresh(index=index)
+    if force_merge_segments:
+        started = time.time()
+        opensearch.indices.forcemerge(
+            index=index,
+            max_num_segments=force_merge_segments,
+            request_timeout=INGEST_MAINTENANCE_TIMEOUT
+        )
+        print(f"Force-merged {index} to {force_merge_segments} segments per shard in {time.time() - started:.1f}s")
+
+    opensearch.indices.put_settings(index=index, body={'index': session['previous']})
+    try:
+        opensearch.delete(index=INGEST_SESSION_INDEX, **record)
+    except (ConflictError, NotFoundError):
+        # Another caller closed the same session first and restored the same settings
+        pass
+    print(f"Closed ingestion session on {index}: restored {session['previous']} after {time.time() - session['started_at']:.0f}s")
+
+    summary = {'force_merged': bool(force_merge_segments)}
+    if warmup:
+        summary['warmup'] = warm_knn_index(index)
+    return summary
+
+# Preload the index's native kNN graphs into memory. Lucene graphs are read
+# through the JVM on demand and have nothing to warm.
+def warm_knn_index(index=None):
+    index = index or write_alias
+    if KNN_ENGINE == 'lucene':
+        return None
+    try:
+        # Restored replicas must be allocated to be warmed along with primaries
+        opensearch.cluster.health(
+            index=index,
+            wait_for_no_initializing_shards=True,
+            timeout=f"{INGEST_MAINTENANCE_TIMEOUT}s",
+            request_timeout=INGEST_MAINTENANCE_TIMEOUT
+        )
+        response = opensearch.plugins.knn.warmup(index=index, request_timeout=INGEST_MAINTENANCE_TIMEOUT)
+        shards = response.get('_shards', {})
+        print(f"Warmed kNN graphs of {index} on {shards.get('successful', 0)}/{shards.get('total', 0)} shards")
+        return shards
+    except Exception as e:
+        # A cold first query is slower, not wrong
+        print(f"kNN warmup of {index} failed: {str(e)}")
+        return None
+
+@contextmanager
+def ingestion_session(index=None, force_merge_segments=None, warmup=None):
+    owner = uuid.uuid4().hex
+    opened = begin_ingestion_session(index, owner)
+    try:
+        yield opened
+    finally:
+        if opened:
+            end_ingestion_session(index, force_merge_segments, warmup, owner)
+
+# Yield the text of each PDF page as it is parsed, optionally limited to
+# pages [page_start, page_end)
+def iter_pdf_pages(file_content, page_start=0, page_end=None):
     pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"
-    return text
+    page_end = len(pdf_reader.pages) if page_end is None else min(page_end, len(pdf_reader.pages))
+    for page_number in range(page_start, page_end):
+        yield pdf_reader.pages[page_number].extract_text() or ""
+
+# Split pages [first_page, page_count) into contiguous ranges, one per worker
+def split_page_range(page_count, workers, first_page=0):
+    workers = max(1, min(workers, page_count - first_page))
+    size, remainder = divmod(page_count - first_page, workers)
+    ranges = []
+    start = first_page
+    for w in range(workers):
+        end = start + size + (1 if w < remainder else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+# Worker process: extract pages [page_start, page_end) from a memory-mapped
+# copy of the PDF and send their text back in small batches
+def extract_page_range_worker(path, page_start, page_end, conn):
+    try:
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                pdf_reader = PyPDF2.PdfReader(mapped)
+                batch = []
+                for page_number in range(page_start, page_end):
+                    batch.append(pdf_reader.pages[page_number].extract_text() or "")
+                    if len(batch) == PDF_PAGES_PER_MESSAGE:
+                        conn.send(('pages', batch))
+                        batch = []
+                if batch:
+                    conn.send(('pages', batch))
+        conn.send(('done', None))
+    except Exception as e:
+        conn.send(('error', f"pages {page_start}-{page_end}: {str(e)}"))
+    finally:
+        conn.close()
+
+# Drain a worker pipe into a bounded queue so every worker keeps extracting,
+# up to PDF_QUEUED_MESSAGES ahead, while the consumer is still reading earlier
+# page ranges. Gives up once stopped, since the consumer has gone away.
+def drain_worker_pipe(conn, results, stopped):
+    def put(message):
+        while not stopped.is_set():
+            try:
+                results.put(message, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-# Extract text based on file type
-def extract_text(bucket, key):
+    try:
+        while True:
+            message = conn.recv()
+            if not put(message) or message[0] != 'pages':
+                break
+    except EOFError:
+        put(('error', 'worker exited without sending results'))
+    finally:
+        conn.close()
+
+# Yield the text of each PDF page from first_page on, extracting page ranges
+# in parallel worker processes and reassembling them in page order
+def iter_pdf_pages_parallel(file_content, workers, first_page=0):
+    page_count = len(PyPDF2.PdfReader(io.BytesIO(file_content)).pages)
+    if first_page >= page_count:
+        return
+    if workers <= 1 or page_count - first_page < PDF_PARALLEL_MIN_PAGES:
+        yield from iter_pdf_pages(file_content, first_page)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as pdf_file:
+        pdf_file.write(file_content)
+        pdf_file.flush()
+
+        processes = []
+        queues = []
+        stopped = threading.Event()
+        for page_start, page_end in split_page_range(page_count, workers, first_page):
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=extract_page_range_worker,
+                args=(pdf_file.name, page_start, page_end, sender),
+                daemon=True
+            )
+            process.start()
+            sender.close()
+            results = queue.Queue(maxsize=PDF_QUEUED_MESSAGES)
+            threading.Thread(target=drain_worker_pipe, args=(receiver, results, stopped), daemon=True).start()
+            processes.append(process)
+            queues.append(results)
+
+        print(f"Extracting {page_count - first_page} pages with {len(processes)} worker processes")
+        try:
+            for results in queues:
+                while True:
+                    kind, payload = results.get()
+                    if kind == 'pages':
+                        yield from payload
+                    elif kind == 'error':
+                        raise RuntimeError(f"PDF extraction failed for {payload}")
+                    else:
+                        break
+        finally:
+            stopped.set()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+# Yield the words of a document page by page (PDF) or line by line (text)
+# so chunking and embedding can start before the whole file is parsed.
+# A page range restricts extraction to pages [page_start, page_end).
+def iter_document_words(bucket, key, page_start=None, page_end=None):
     try:
         response = s3.get_object(Bucket=bucket, Key=key)
-        file_content = response['Body'].read()
+
+        if page_start is not None and not key.lower().endswith('.pdf'):
+            raise ValueError(f"Page ranges are only supported for PDF documents: {key}")
 
         if key.lower().endswith('.pdf'):
-            return extract_text_from_pdf(file_content)
+            # PdfReader needs a seekable stream, so the raw bytes are read
+            # once; the extracted text is never held for the whole document
+            file_content = response['Body'].read()
+            if page_start is not None:
+                pages = iter_pdf_pages(file_content, page_start, page_end)
+            else:
+                pages = iter_pdf_pages_parallel(file_content, PDF_EXTRACT_WORKERS)
+            for page_number, page_text in enumerate(pages):
+                if page_number == 0:
+                    print(f"Extracted text (first 100 chars): {page_text[:100]}")
+                yield from page_text.split()
         elif key.lower().endswith('.txt'):
-            return file_content.decode('utf-8')
+            for line in response['Body'].iter_lines():
+                yield from line.decode('utf-8').split()
         else:
             raise ValueError(f"Unsupported file type: {key}")
     except Exception as e:
         print(f"Error extracting text: {str(e)}")
         raise
 
-# Chunk text into smaller segments
-def chunk_text(text, chunk_size=500, overlap=100):
-    words = text.split()
-    chunks = []
+# Whether the words ending at a position form a content-defined cut point
+def is_cut_point(window):
+    return zlib.crc32(' '.join(window).encode('utf-8')) % CHUNK_CUT_DIVISOR == 0
 
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = ' '.join(words[i:i + chunk_size])
-        chunks.append(chunk)
+# Chunk a stream of words into overlapping segments at content-defined
+# boundaries, holding at most one chunk of words in memory at a time
+def iter_chunks(words, min_words=CHUNK_MIN_WORDS, max_words=CHUNK_MAX_WORDS, overlap=CHUNK_OVERLAP_WORDS):
+    carried = []
+    segment = []
+    window = deque(maxlen=CHUNK_HASH_WINDOW)
 
-    return chunks
+    for word in words:
+        segment.append(word)
+        window.append(word)
+        if len(segment) >= max_words or (len(segment) >= min_words and is_cut_point(window)):
+            yield ' '.join(carried + segment)
+            carried = segment[-overlap:] if overlap else []
+            segment = []
 
-# Generate embeddings using Amazon Bedrock
-def generate_embedding(text):
-    try:
-        model_id = "amazon.titan-embed-text-v2:0"  # Updated model ID
-        body = json.dumps({"inputText": text})
+    if segment:
+        yield ' '.join(carried + segment)
+
+# Additive-increase / multiplicative-decrease limit on concurrent Bedrock calls
+class AIMDController:
+    def __init__(self, initial, minimum=1, maximum=16, increase=1.0, decrease=0.5, cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, outcome):
+        with self._cond:
+            self.in_flight -= 1
+            if outcome == 'success':
+                # Grow by roughly one slot per window of successful calls
+                self.successes += 1
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            elif outcome == 'congested':
+                # Halve at most once per cooldown so a burst of throttles
+                # from the same window does not collapse the limit to 1
+                self.throttles += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': round(self.limit, 2),
+                'successes': self.successes,
+                'throttles': self.throttles
+            }
 
-        response = bedrock_runtime.invoke_model(
-            modelId=model_id,
-            body=body
+embedding_controller = AIMDController(
+    EMBED_INITIAL_CONCURRENCY,
+    maximum=EMBED_MAX_CONCURRENCY
+)
+
+# Embedding cache configuration. Backends: 'memory' (per-container LRU),
+# 'sqlite' (LRU in front of a local SQLite file) or 'none'.
+EMBEDDING_CACHE_BACKEND = os.environ.get('EMBEDDING_CACHE_BACKEND', 'memory')
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', '10000'))
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', '/tmp/embedding_cache.sqlite3')
+
+# In-memory LRU store holding vectors compactly as float32 arrays
+class LRUEmbeddingStore:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                return None
+            self._entries.move_to_end(key)
+            return vector.tolist()
+
+    def put(self, key, embedding):
+        with self._lock:
+            self._entries[key] = array('f', embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# SQLite-backed store standing in for a persistent cache
+class SQLiteEmbeddingStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)'
         )
+        self._conn.commit()
 
-        response_body = json.loads(response['body'].read())
-        embedding = response_body.get('embedding')
-        
-        if not embedding:
-            print(f"Warning: No embedding returned for text: {text[:50]}...")
-            # Return a default embedding of zeros as fallback
-            return [0.0] * 1536
-            
-        print(f"Generated embedding (partial): {embedding[:5]}")
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT vector FROM embeddings WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        vector = array('f')
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def put(self, key, embedding):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                (key, array('f', embedding).tobytes())
+            )
+            self._conn.commit()
+
+# Content-addressed embedding cache checked before calling Bedrock. Stores
+# are consulted in order and earlier tiers are back-filled on a hit.
+class EmbeddingCache:
+    def __init__(self, stores):
+        self.stores = stores
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text, model_id, dimension):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{model_id}:{dimension}:{digest}"
+
+    def get(self, key):
+        for tier, store in enumerate(self.stores):
+            embedding = store.get(key)
+            if embedding is not None:
+                for earlier in self.stores[:tier]:
+                    earlier.put(key, embedding)
+                with self._lock:
+                    self.hits += 1
+                return embedding
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, embedding):
+        for store in self.stores:
+            store.put(key, embedding)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Build the embedding cache for the configured backend
+def create_embedding_cache():
+    if EMBEDDING_CACHE_BACKEND == 'none':
+        return EmbeddingCache([])
+    stores = [LRUEmbeddingStore(EMBEDDING_CACHE_SIZE)]
+    if EMBEDDING_CACHE_BACKEND == 'sqlite':
+        stores.append(SQLiteEmbeddingStore(EMBEDDING_CACHE_PATH))
+    return EmbeddingCache(stores)
+
+embedding_cache = create_embedding_cache()
+
+# Invoke the embedding model, retrying with jittered backoff when throttled
+def invoke_embedding_model(text):
+    model_id = EMBEDDING_MODEL_ID
+    body = json.dumps({
+        "inputText": text,
+        "dimensions": EMBEDDING_DIMENSION,
+        "normalize": True
+    })
+
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        outcome = 'error'
+        embedding_controller.acquire()
+        try:
+            response = bedrock_runtime.invoke_model(
+                modelId=model_id,
+                body=body
+            )
+            outcome = 'success'
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in CONGESTION_ERROR_CODES:
+                raise
+            outcome = 'congested'
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+        finally:
+            embedding_controller.release(outcome)
+
+        if outcome == 'success':
+            response_body = json.loads(response['body'].read())
+            return response_body.get('embedding')
+
+        time.sleep(random.uniform(0, min(EMBED_MAX_BACKOFF, EMBED_BASE_BACKOFF * 2 ** attempt)))
+
+# Generate embeddings using Amazon Bedrock. Errors, including throttling that
+# outlasts EMBED_MAX_RETRIES, are raised: a chunk without an embedding is
+# reported as failed rather than indexed with a meaningless vector.
+def generate_embedding(text):
+    cache_key = EmbeddingCache.make_key(text, EMBEDDING_MODEL_ID, EMBEDDING_DIMENSION)
+    embedding = embedding_cache.get(cache_key)
+    if embedding is not None:
         return embedding
+
+    embedding = invoke_embedding_model(text)
+    if not embedding:
+        raise ValueError(f"No embedding returned for text: {text[:50]}...")
+
+    print(f"Generated embedding (partial): {embedding[:5]}")
+    embedding_cache.put(cache_key, embedding)
+    return embedding
+
+# Re-indexing mode: 'incremental' diffs chunk fingerprints against what is
+# already stored for the document, 'full' re-embeds every chunk positionally
+REINDEX_MODE = os.environ.get('REINDEX_MODE', 'incremental')
+
+# Embed (key, text) pairs concurrently, yielding (key, text, embedding, error)
+# in input order; embedding is None and error describes the failure when a
+# chunk could not be embedded. At most two windows of work are queued so
+# memory stays bounded.
+def embed_chunks(items):
+    def completed(key, chunk, future):
+        try:
+            return key, chunk, future.result(), None
+        except Exception as e:
+            print(f"Error generating embedding: {str(e)}")
+            return key, chunk, None, str(e)
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY) as executor:
+        for key, chunk in items:
+            pending.append((key, chunk, executor.submit(generate_embedding, chunk)))
+            if len(pending) >= EMBED_MAX_CONCURRENCY * 2:
+                yield completed(*pending.popleft())
+
+        while pending:
+            yield completed(*pending.popleft())
+
+# Failure entry, in the form run_bulk reports, for a chunk that was skipped
+# because it could not be embedded
+def embedding_failure(chunk_id, error):
+    return {'id': chunk_id, 'action': 'embed', 'status': None, 'error': error}
+
+# Scalar-quantize a normalized vector to signed bytes for 'byte' storage
+def quantize_to_bytes(vector):
+    scale = 127 / BYTE_QUANTIZATION_RANGE
+    return [max(-128, min(127, round(x * scale))) for x in vector]
+
+# Convert a model embedding to the configured storage form. Vectors read back
+# from the index are already in stored form.
+def to_stored_embedding(embedding, stored=False):
+    if VECTOR_STORAGE == 'byte':
+        return [int(x) for x in embedding] if stored else quantize_to_bytes(embedding)
+    return embedding
+
+# Fingerprint a chunk by the sha256 of its text
+def fingerprint_chunk(chunk):
+    return hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+
+# Build the OpenSearch document for a single chunk
+def build_chunk_document(document_id, chunk_id, i, chunk, embedding, page_start=None, run_id=None, stored=False):
+    # Vectors are stored at their native dimension; a mismatch is rejected
+    # by OpenSearch and reported as a failed bulk item
+    if len(embedding) != EMBEDDING_DIMENSION:
+        print(f"Warning: Embedding dimension {len(embedding)} doesn't match expected {EMBEDDING_DIMENSION}")
+    document = {
+        'embedding': to_stored_embedding(embedding, stored),
+        'text': chunk,
+        'document_id': document_id,
+        'chunk_id': chunk_id,
+        'chunk_hash': fingerprint_chunk(chunk),
+        'metadata': {
+            'source': document_id,
+            'chunk_number': i
+        }
+    }
+    # Chunks indexed by fan-out workers are numbered within their page range
+    # and tagged with the ingestion run that wrote them
+    if page_start is not None:
+        document['metadata']['page_start'] = page_start
+    if run_id:
+        document['ingest_run'] = run_id
+    return document
+
+# Generate bulk index actions from the concurrently embedded chunks. Chunks
+# that could not be embedded are skipped and appended to failures. Chunk IDs
+# written by a fan-out run carry the run id, so they never overwrite the
+# chunks of an earlier run that a failed run must leave in place.
+def generate_bulk_actions(document_id, chunks, failures, page_start=None, run_id=None, start=0):
+    prefix = document_id
+    if run_id:
+        prefix = f"{prefix}_{run_id[:8]}"
+    if page_start is not None:
+        prefix = f"{prefix}_p{page_start}"
+    items = (((i, f"{prefix}_{i}"), chunk) for i, chunk in enumerate(chunks, start))
+    for (i, chunk_id), chunk, embedding, error in embed_chunks(items):
+        if error:
+            failures.append(embedding_failure(chunk_id, error))
+            continue
+        yield {
+            '_op_type': 'index',
+            '_index': write_alias,
+            '_id': chunk_id,
+            '_source': build_chunk_document(document_id, chunk_id, i, chunk, embedding, page_start, run_id)
+        }
+
+# Fetch the IDs and chunk positions already indexed for a document
+def get_indexed_chunks(document_id):
+    indexed = {}
+    for hit in helpers.scan(
+        opensearch,
+        index=write_alias,
+        query={'query': {'term': {'document_id': document_id}}},
+        _source=['metadata.chunk_number']
+    ):
+        indexed[hit['_id']] = hit['_source'].get('metadata', {}).get('chunk_number')
+    return indexed
+
+# Read stored vectors for the given chunk IDs back from doc values, since
+# the embedding is excluded from _source. Returns {chunk_id: vector}.
+def fetch_stored_vectors(chunk_ids):
+    if not chunk_ids:
+        return {}
+    try:
+        response = opensearch.search(
+            index=write_alias,
+            body={
+                'size': len(chunk_ids),
+                'query': {'ids': {'values': list(chunk_ids)}},
+                '_source': False,
+                'script_fields': EMBEDDING_SCRIPT_FIELDS
+            }
+        )
     except Exception as e:
-        print(f"Error generating embedding: {str(e)}")
-        # Return a default embedding of zeros as fallback
-        return [0.0] * 1536
+        print(f"Could not read stored vectors: {str(e)}")
+        return {}
+
+    vectors = {}
+    for hit in response['hits']['hits']:
+        vector = vector_from_hit(hit)
+        if vector is not None:
+            vectors[hit['_id']] = vector
+    return vectors
+
+# Extract the vector returned by EMBEDDING_SCRIPT_FIELDS from a search hit
+def vector_from_hit(hit):
+    values = hit.get('fields', {}).get('embedding')
+    if not values:
+        return None
+    return values[0] if isinstance(values[0], list) else values
 
-# Index chunks to OpenSearch
-def index_chunks(document_id, chunks):
+# Re-index chunks whose position changed with their stored vectors. A partial
+# update would rebuild the document from _source and drop the vector, so the
+# full document is written; chunks whose vector cannot be read are re-embedded,
+# and left in place and appended to failures if that fails.
+def relocate_chunks(document_id, moved, failures):
+    for batch_start in range(0, len(moved), RELOCATE_BATCH_SIZE):
+        batch = moved[batch_start:batch_start + RELOCATE_BATCH_SIZE]
+        vectors = fetch_stored_vectors([chunk_id for _, chunk_id, _ in batch])
+        for i, chunk_id, chunk in batch:
+            if chunk_id in vectors:
+                document = build_chunk_document(document_id, chunk_id, i, chunk, vectors[chunk_id], stored=True)
+            else:
+                try:
+                    embedding = generate_embedding(chunk)
+                except Exception as e:
+                    print(f"Error generating embedding: {str(e)}")
+                    failures.append(embedding_failure(chunk_id, str(e)))
+                    continue
+                document = build_chunk_document(document_id, chunk_id, i, chunk, embedding)
+            yield {
+                '_op_type': 'index',
+                '_index': write_alias,
+                '_id': chunk_id,
+                '_source': document
+            }
+
+# Yield (i, chunk_id, chunk) with IDs derived from content fingerprints; text
+# repeated within the document gets its occurrence number appended
+def content_chunk_ids(document_id, chunks):
+    occurrences = {}
     for i, chunk in enumerate(chunks):
-        try:
-            # Generate embedding for the chunk
-            embedding = generate_embedding(chunk)
-            
-            # Ensure embedding is the correct dimension
-            if len(embedding) != 1536:
-                print(f"Warning: Embedding dimension {len(embedding)} doesn't match expected 1536")
-                if len(embedding) < 1536:
-                    embedding = embedding + [0.0] * (1536 - len(embedding))
+        digest = fingerprint_chunk(chunk)
+        occurrence = occurrences.get(digest, 0)
+        occurrences[digest] = occurrence + 1
+        chunk_id = f"{document_id}_{digest[:20]}"
+        if occurrence:
+            chunk_id = f"{chunk_id}_{occurrence}"
+        yield i, chunk_id, chunk
+
+# Generate bulk actions that bring the stored chunks of a document in line
+# with the new chunk list. Chunk IDs are derived from content fingerprints,
+# so unchanged text keeps its ID: only new chunks are embedded, moved chunks
+# are re-indexed with their stored vectors, and chunks that no longer exist
+# are deleted. New chunks that could not be embedded are skipped and appended
+# to failures; they stay unindexed, so the next run embeds them again.
+def generate_incremental_actions(document_id, chunks, indexed, diff, failures, progress=None):
+    current_ids = set()
+    moved = []
+
+    def new_chunks():
+        for i, chunk_id, chunk in content_chunk_ids(document_id, chunks):
+            current_ids.add(chunk_id)
+
+            if chunk_id not in indexed:
+                diff['new'] += 1
+                yield (i, chunk_id), chunk
+            elif indexed[chunk_id] != i:
+                diff['moved'] += 1
+                moved.append((i, chunk_id, chunk))
+            else:
+                diff['unchanged'] += 1
+
+    for (i, chunk_id), chunk, embedding, error in embed_chunks(new_chunks()):
+        if error:
+            failures.append(embedding_failure(chunk_id, error))
+        else:
+            yield {
+                '_op_type': 'index',
+                '_index': write_alias,
+                '_id': chunk_id,
+                '_source': build_chunk_document(document_id, chunk_id, i, chunk, embedding)
+            }
+        if len(moved) >= RELOCATE_BATCH_SIZE:
+            yield from relocate_chunks(document_id, moved, failures)
+            moved.clear()
+
+    yield from relocate_chunks(document_id, moved, failures)
+
+    # A chunk stream cut short by a checkpoint has not seen the whole
+    # document, so nothing can be considered orphaned yet
+    if progress and progress.get('interrupted'):
+        return
+
+    for chunk_id in indexed:
+        if chunk_id not in current_ids:
+            diff['deleted'] += 1
+            yield {
+                '_op_type': 'delete',
+                '_index': write_alias,
+                '_id': chunk_id
+            }
+
+# Send bulk actions to OpenSearch, counting successes per operation type.
+# Failed items are appended to failures, which the action generator may
+# already be filling with chunks it skipped.
+def run_bulk(actions, document_id, failures=None):
+    if BULK_THREAD_COUNT > 1:
+        results = helpers.parallel_bulk(
+            opensearch,
+            actions,
+            thread_count=BULK_THREAD_COUNT,
+            chunk_size=BULK_CHUNK_SIZE,
+            max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+            raise_on_error=False,
+            raise_on_exception=False
+        )
+    else:
+        results = helpers.streaming_bulk(
+            opensearch,
+            actions,
+            chunk_size=BULK_CHUNK_SIZE,
+            max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+            max_retries=BULK_MAX_RETRIES,
+            raise_on_error=False,
+            raise_on_exception=False
+        )
+
+    succeeded = {'index': 0, 'update': 0, 'delete': 0}
+    failures = [] if failures is None else failures
+    for ok, item in results:
+        action, info = next(iter(item.items()))
+        if ok:
+            succeeded[action] = succeeded.get(action, 0) + 1
+        else:
+            error = info.get('error', info.get('exception', 'unknown error'))
+            print(f"Error on {action} of chunk {info.get('_id')} for document {document_id}: {error}")
+            failures.append({'id': info.get('_id'), 'action': action, 'status': info.get('status'), 'error': str(error)})
+
+    return succeeded, failures
+
+# Copy every chunk of source_index into target_index, re-embedding its text
+# with the configured model and dimension. IDs and fields are preserved.
+def reembed_index(source_index, target_index=None):
+    target_index = target_index or write_alias
+    hits = helpers.scan(
+        opensearch,
+        index=source_index,
+        query={'query': {'match_all': {}}},
+        _source_excludes=['embedding']
+    )
+    items = (((hit['_id'], hit['_source']), hit['_source']['text']) for hit in hits)
+    failures = []
+
+    def actions():
+        for (doc_id, source), text, embedding, error in embed_chunks(items):
+            if error:
+                failures.append(embedding_failure(doc_id, error))
+                continue
+            yield {
+                '_op_type': 'index',
+                '_index': target_index,
+                '_id': doc_id,
+                '_source': {**source, 'embedding': to_stored_embedding(embedding)}
+            }
+
+    succeeded, failures = run_bulk(actions(), source_index, failures)
+    print(f"Re-embedded {succeeded['index']} chunks from {source_index} into {target_index} ({len(failures)} failed)")
+    return {
+        'indexed': succeeded['index'],
+        'failed': len(failures),
+        'errors': failures[:10]
+    }
+
+# Copy every chunk of source_index into target_index without re-embedding,
+# reading each slice of a sliced scroll on its own thread. Stored vectors
+# are read from doc values, so both indexes must share dimension and storage.
+def copy_index(source_index, target_index, slices=None):
+    slices = max(1, slices or REINDEX_SLICES)
+    source_field = next(iter(opensearch.indices.get_mapping(index=source_index).values()))['mappings']['properties']['embedding']
+    target_field = build_embedding_field()
+    for setting in ('dimension', 'data_type'):
+        if source_field.get(setting) != target_field.get(setting):
+            raise ValueError(f"{source_index} has embedding {setting} {source_field.get(setting)}, "
+                             f"the target needs {target_field.get(setting)}; re-embed instead of copying")
+
+    def copy_slice(slice_id):
+        query = {'query': {'match_all': {}}, '_source': True, 'script_fields': EMBEDDING_SCRIPT_FIELDS}
+        if slices > 1:
+            query['slice'] = {'id': slice_id, 'max': slices}
+
+        failures = []
+
+        def actions():
+            for hit in helpers.scan(opensearch, index=source_index, query=query, size=REINDEX_SCROLL_SIZE):
+                vector = vector_from_hit(hit)
+                if vector is not None:
+                    embedding = to_stored_embedding(vector, stored=True)
                 else:
-                    embedding = embedding[:1536]
-            
-            document = {
-                'embedding': embedding,
-                'text': chunk,
-                'document_id': document_id,
-                'chunk_id': f"{document_id}_{i}",
-                'metadata': {
-                    'source': document_id,
-                    'chunk_number': i
+                    try:
+                        embedding = to_stored_embedding(generate_embedding(hit['_source']['text']))
+                    except Exception as e:
+                        print(f"Error generating embedding: {str(e)}")
+                        failures.append(embedding_failure(hit['_id'], str(e)))
+                        continue
+                yield {
+                    '_op_type': 'index',
+                    '_index': target_index,
+                    '_id': hit['_id'],
+                    '_source': {**hit['_source'], 'embedding': embedding}
                 }
-            }
 
-            opensearch.index(
-                index=index_name,
-                body=document,
-                id=f"{document_id}_{i}"
-            )
-            print(f"Successfully indexed chunk {i} for document {document_id}")
-        except Exception as e:
-            print(f"Error indexing chunk {i} for document {document_id}: {str(e)}")
+        return run_bulk(actions(), f"{source_index} slice {slice_id}", failures)
+
+    with ThreadPoolExecutor(max_workers=slices) as executor:
+        results = list(executor.map(copy_slice, range(slices)))
+
+    indexed = sum(succeeded['index'] for succeeded, _ in results)
+    failures = [failure for _, slice_failures in results for failure in slice_failures]
+    print(f"Copied {indexed} chunks from {source_index} into {target_index} over {slices} slices ({len(failures)} failed)")
+    return {
+        'indexed': indexed,
+        'failed': len(failures),
+        'errors': failures[:10]
+    }
+
+# Index chunks to OpenSearch using the bulk API
+def index_chunks(document_id, chunks, mode=None, page_start=None, run_id=None, start=0, progress=None):
+    mode = mode or REINDEX_MODE
+    diff = {'new': 0, 'moved': 0, 'unchanged': 0, 'deleted': 0}
+    totals = {'chunks': 0}
+
+    # Count chunks as they stream through, since the total is not known upfront
+    def counted(chunks):
+        for chunk in chunks:
+            totals['chunks'] += 1
+            yield chunk
+
+    chunks = counted(chunks)
+    failures = []
+
+    if mode == 'incremental':
+        indexed = get_indexed_chunks(document_id)
+        print(f"Found {len(indexed)} chunks already indexed for document {document_id}")
+        actions = generate_incremental_actions(document_id, chunks, indexed, diff, failures, progress)
+    else:
+        actions = generate_bulk_actions(document_id, chunks, failures, page_start, run_id, start)
+
+    succeeded, failures = run_bulk(actions, document_id, failures)
+
+    print(f"Created {totals['chunks']} chunks")
+    print(f"Bulk indexed {succeeded['index']} chunks for document {document_id} ({len(failures)} failed)")
+    if mode == 'incremental':
+        print(f"Incremental diff for document {document_id}: {diff}")
+    print(f"Embedding concurrency: {embedding_controller.stats()}")
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    result = {
+        'mode': mode,
+        'chunks': totals['chunks'],
+        'indexed': succeeded['index'],
+        'failed': len(failures),
+        'errors': failures[:10]
+    }
+    if mode == 'incremental':
+        result.update({
+            'deleted': succeeded['delete'],
+            'diff': diff
+        })
+    return result
+
+# Records fan-out progress as JSON objects under an S3 prefix
+class S3CompletionTracker:
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, run_id, name):
+        return f"{self.prefix}{run_id}/{name}.json"
+
+    def start(self, run_id, manifest):
+        s3.put_object(Bucket=self.bucket, Key=self._key(run_id, 'manifest'), Body=json.dumps(manifest))
+
+    def manifest(self, run_id):
+        response = s3.get_object(Bucket=self.bucket, Key=self._key(run_id, 'manifest'))
+        return json.loads(response['Body'].read())
+
+    def record(self, run_id, part, result):
+        s3.put_object(Bucket=self.bucket, Key=self._key(run_id, f"parts/{part}"), Body=json.dumps(result))
+
+    def parts_location(self, run_id):
+        return {'bucket': self.bucket, 'prefix': f"{self.prefix}{run_id}/parts/"}
+
+    def completed(self, run_id):
+        parts = {}
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.parts_location(run_id)['prefix']):
+            for obj in page.get('Contents', []):
+                response = s3.get_object(Bucket=self.bucket, Key=obj['Key'])
+                parts[obj['Key'].rsplit('/', 1)[-1][:-len('.json')]] = json.loads(response['Body'].read())
+        return parts
+
+    def finish(self, run_id, outcome):
+        s3.put_object(Bucket=self.bucket, Key=self._key(run_id, 'final'), Body=json.dumps(outcome))
+
+    def finished(self, run_id):
+        try:
+            response = s3.get_object(Bucket=self.bucket, Key=self._key(run_id, 'final'))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+# Records fan-out progress as JSON files in a local directory
+class FileCompletionTracker:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, run_id, name):
+        return os.path.join(self.directory, run_id, f"{name}.json")
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def start(self, run_id, manifest):
+        self._write(self._path(run_id, 'manifest'), manifest)
+
+    def manifest(self, run_id):
+        with open(self._path(run_id, 'manifest')) as f:
+            return json.load(f)
+
+    def record(self, run_id, part, result):
+        self._write(self._path(run_id, f"parts/{part}"), result)
+
+    def parts_location(self, run_id):
+        return {'directory': os.path.join(self.directory, run_id, 'parts')}
+
+    def completed(self, run_id):
+        parts = {}
+        parts_dir = self.parts_location(run_id)['directory']
+        if os.path.isdir(parts_dir):
+            for name in os.listdir(parts_dir):
+                if name.endswith('.json'):
+                    with open(os.path.join(parts_dir, name)) as f:
+                        parts[name[:-len('.json')]] = json.load(f)
+        return parts
+
+    def finish(self, run_id, outcome):
+        self._write(self._path(run_id, 'final'), outcome)
+
+    def finished(self, run_id):
+        try:
+            with open(self._path(run_id, 'final')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+# Dispatches fan-out workers as asynchronous Lambda invocations
+class LambdaDispatcher:
+    def __init__(self, function_name):
+        self.function_name = function_name
+
+    def dispatch(self, payload):
+        lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='Event',
+            Payload=bytes(json.dumps(payload), 'utf-8')
+        )
+
+    def wait(self):
+        pass
+
+# Runs fan-out workers on local threads, standing in for Lambda invocations
+class LocalDispatcher:
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+
+    def dispatch(self, payload):
+        self.futures.append(self.executor.submit(lambda_handler, payload, None))
+
+    # Worker errors are logged rather than raised, as Lambda would for an
+    # asynchronous invocation
+    def wait(self):
+        self.executor.shutdown(wait=True)
+        results = []
+        for future in self.futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Fan-out worker failed: {str(e)}")
+        return results
+
+# Build the completion tracker for the configured backend. The S3 tracker
+# lives in the bucket of the document being ingested, which the function's
+# role can already write to.
+def create_ingest_tracker(bucket):
+    if INGEST_TRACKER == 'file':
+        return FileCompletionTracker(INGEST_TRACKER_DIR)
+    return S3CompletionTracker(bucket, INGEST_TRACKER_PREFIX)
+
+# Build the worker dispatcher for the configured backend
+def create_dispatcher(context):
+    if INGEST_DISPATCH == 'local':
+        return LocalDispatcher()
+    function_name = EMBED_FUNCTION_NAME or getattr(context, 'function_name', None)
+    if not function_name:
+        raise ValueError("EMBED_FUNCTION_NAME must be set to dispatch fan-out workers")
+    return LambdaDispatcher(function_name)
+
+# Split a PDF into page ranges and dispatch one worker invocation per range
+def start_fan_out(bucket, key, document_id, fan_out, context):
+    if not key.lower().endswith('.pdf'):
+        raise ValueError(f"Fan-out ingestion is only supported for PDF documents: {key}")
+
+    response = s3.get_object(Bucket=bucket, Key=key)
+    page_count = len(PyPDF2.PdfReader(io.BytesIO(response['Body'].read())).pages)
+    ranges = split_page_range(page_count, fan_out)
+    run_id = uuid.uuid4().hex
+
+    # The worker that finalizes the run closes the session if this run opened it
+    session = begin_ingestion_session(owner=run_id)
+    tracker = create_ingest_tracker(bucket)
+    dispatched = 0
+    try:
+        tracker.start(run_id, {
+            'key': key,
+            'document_id': document_id,
+            'page_count': page_count,
+            'parts': [f"{page_start}-{page_end}" for page_start, page_end in ranges],
+            'session': session
+        })
+
+        dispatcher = create_dispatcher(context)
+        for page_start, page_end in ranges:
+            dispatcher.dispatch({
+                'bucket': bucket,
+                'key': key,
+                'page_start': page_start,
+                'page_end': page_end,
+                'run_id': run_id
+            })
+            dispatched += 1
+    except Exception as e:
+        print(f"Dispatch of run {run_id} failed after {dispatched} of {len(ranges)} workers: {str(e)}")
+        if dispatched:
+            # The dispatched workers settle the run, and close its session,
+            # once the ranges that were never dispatched are recorded as failed
+            for page_start, page_end in ranges[dispatched:]:
+                complete_part(tracker, run_id, document_id, f"{page_start}-{page_end}",
+                              {'status': 'failed', 'error': f"not dispatched: {str(e)}"})
+        elif session:
+            end_ingestion_session(owner=run_id)
+        raise
+    print(f"Dispatched {len(ranges)} workers for {page_count} pages of {key} (run {run_id})")
+    dispatcher.wait()
+
+    return {
+        'run_id': run_id,
+        'document_id': document_id,
+        'page_count': page_count,
+        'parts': len(ranges),
+        'session': session,
+        'tracker': tracker.parts_location(run_id)
+    }
+
+# Settle a run whose parts have all been recorded. When every part succeeded,
+# chunks left by earlier runs are deleted; when any failed, the run's own
+# chunks are deleted instead so the previous version stays searchable without
+# duplicates; the run's chunk IDs are its own, so no earlier chunk was
+# overwritten. Returns the outcome, also recorded as the run's final state.
+def finalize_fan_out(run_id, document_id, parts):
+    failed = sorted(part for part, result in parts.items() if result.get('status') == 'failed')
+    query = {'bool': {'filter': [{'term': {'document_id': document_id}}]}}
+    # The run's ingestion session suspends refresh, and delete_by_query only
+    # sees chunks that have been refreshed
+    opensearch.indices.refresh(index=write_alias)
+    if failed:
+        query['bool']['filter'].append({'term': {'ingest_run': run_id}})
+    else:
+        query['bool']['must_not'] = [{'term': {'ingest_run': run_id}}]
+    response = opensearch.delete_by_query(index=write_alias, body={'query': query}, conflicts='proceed')
+
+    if failed:
+        print(f"Run {run_id} failed for pages {', '.join(failed)}: "
+              f"deleted its {response.get('deleted', 0)} chunks of {document_id}")
+    else:
+        print(f"Finalized run {run_id}: deleted {response.get('deleted', 0)} stale chunks of {document_id}")
+    return {'status': 'failed' if failed else 'succeeded', 'failed_parts': failed, 'deleted': response.get('deleted', 0)}
+
+# Record a part's result and settle the run if it was the last outstanding
+# part, closing the run's ingestion session if it opened one
+def complete_part(tracker, run_id, document_id, part, result):
+    tracker.record(run_id, part, result)
+    manifest = tracker.manifest(run_id)
+    parts = tracker.completed(run_id)
+    if set(manifest['parts']) <= set(parts):
+        try:
+            tracker.finish(run_id, finalize_fan_out(run_id, document_id, parts))
+        finally:
+            if manifest.get('session'):
+                end_ingestion_session(owner=run_id)
+
+# Index one page range of a document as a fan-out worker. A failed range is
+# recorded with its error, so the run is still settled once every part has
+# reported, and the error is raised for Lambda to retry the invocation. A
+# retry that arrives after the run was settled does nothing.
+def process_page_range(bucket, key, document_id, page_start, page_end, run_id=None):
+    if not run_id:
+        chunks = iter_chunks(iter_document_words(bucket, key, page_start, page_end))
+        return index_chunks(document_id, chunks, mode='full', page_start=page_start)
+
+    tracker = create_ingest_tracker(bucket)
+    part = f"{page_start}-{page_end}"
+    final = tracker.finished(run_id)
+    if final:
+        print(f"Run {run_id} was already settled ({final['status']}); skipping pages {part}")
+        return {'status': 'skipped', 'run': final}
+
+    try:
+        chunks = iter_chunks(iter_document_words(bucket, key, page_start, page_end))
+        result = index_chunks(document_id, chunks, mode='full', page_start=page_start, run_id=run_id)
+    except Exception as e:
+        print(f"Pages {part} of run {run_id} failed: {str(e)}")
+        complete_part(tracker, run_id, document_id, part, {'status': 'failed', 'error': str(e)})
+        raise
+    complete_part(tracker, run_id, document_id, part, {'status': 'succeeded', **result})
+    return result
+
+# Stores checkpoint state and extracted-text artifacts under an S3 prefix
+class S3CheckpointStore:
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load(self, document_id):
+        try:
+            response = s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{document_id}/state.json")
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def save(self, document_id, state, artifact_path=None):
+        if artifact_path and os.path.exists(artifact_path):
+            s3.upload_file(artifact_path, self.bucket, f"{self.prefix}{document_id}/text.txt")
+        s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}{document_id}/state.json", Body=json.dumps(state))
+
+    def restore_artifact(self, document_id, artifact_path):
+        try:
+            s3.download_file(self.bucket, f"{self.prefix}{document_id}/text.txt", artifact_path)
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, document_id):
+        s3.delete_objects(Bucket=self.bucket, Delete={'Objects': [
+            {'Key': f"{self.prefix}{document_id}/state.json"},
+            {'Key': f"{self.prefix}{document_id}/text.txt"}
+        ]})
+
+# Stores checkpoint state and extracted-text artifacts in a local directory
+class FileCheckpointStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, document_id, name):
+        return os.path.join(self.directory, document_id, name)
+
+    def load(self, document_id):
+        try:
+            with open(self._path(document_id, 'state.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, document_id, state, artifact_path=None):
+        os.makedirs(os.path.join(self.directory, document_id), exist_ok=True)
+        if artifact_path and os.path.exists(artifact_path):
+            shutil.copyfile(artifact_path, self._path(document_id, 'text.txt'))
+        with open(self._path(document_id, 'state.json'), 'w') as f:
+            json.dump(state, f)
+
+    def restore_artifact(self, document_id, artifact_path):
+        if not os.path.exists(self._path(document_id, 'text.txt')):
+            return False
+        shutil.copyfile(self._path(document_id, 'text.txt'), artifact_path)
+        return True
+
+    def delete(self, document_id):
+        shutil.rmtree(os.path.join(self.directory, document_id), ignore_errors=True)
+
+# Build the checkpoint store for the configured backend. S3 checkpoints are
+# kept in the bucket of the document being ingested.
+def create_checkpoint_store(bucket):
+    if CHECKPOINT_STORE == 'file':
+        return FileCheckpointStore(CHECKPOINT_DIR)
+    return S3CheckpointStore(bucket, CHECKPOINT_PREFIX)
+
+# Yield document words while appending extracted PDF pages to a local text
+# artifact (one page per line). Text restored from a checkpoint is replayed
+# first and parsing resumes at the first page it does not cover.
+def iter_checkpointed_words(bucket, key, progress, artifact_path):
+    if not key.lower().endswith('.pdf'):
+        yield from iter_document_words(bucket, key)
+        return
+
+    if os.path.exists(artifact_path):
+        with open(artifact_path, encoding='utf-8') as artifact:
+            for line in artifact:
+                yield from line.split()
+
+    response = s3.get_object(Bucket=bucket, Key=key)
+    pages = iter_pdf_pages_parallel(response['Body'].read(), PDF_EXTRACT_WORKERS, progress['pages_extracted'])
+    with open(artifact_path, 'a', encoding='utf-8') as artifact:
+        for page_text in pages:
+            artifact.write(' '.join(page_text.split()) + '\n')
+            progress['pages_extracted'] += 1
+            yield from page_text.split()
+
+# Stop consuming chunks once the invocation is close to its timeout
+def until_deadline(chunks, context, progress):
+    for chunk in chunks:
+        if context is not None and context.get_remaining_time_in_millis() < CHECKPOINT_RESERVE_MS:
+            progress['interrupted'] = True
+            print(f"Less than {CHECKPOINT_RESERVE_MS} ms remaining, checkpointing after {progress['offset']} chunks")
+            return
+        progress['offset'] += 1
+        yield chunk
+
+# Ingest a whole document, checkpointing before the invocation times out.
+# A resumed invocation restores the extracted text and the committed chunk
+# offset, so neither parsing nor embedding is repeated for finished work.
+def ingest_document(bucket, key, document_id, mode=None, context=None, resume=False):
+    mode = mode or REINDEX_MODE
+    store = create_checkpoint_store(bucket)
+    state = store.load(document_id) if resume else None
+    artifact_path = os.path.join(tempfile.gettempdir(), f"{document_id}.checkpoint.txt")
+    if os.path.exists(artifact_path):
+        os.remove(artifact_path)
+
+    progress = {'offset': 0, 'pages_extracted': 0, 'interrupted': False}
+    if state:
+        progress['offset'] = state['offset']
+        if store.restore_artifact(document_id, artifact_path):
+            progress['pages_extracted'] = state['pages_extracted']
+        print(f"Resuming {key} from chunk {progress['offset']} and page {progress['pages_extracted']}")
+
+    try:
+        words = iter_checkpointed_words(bucket, key, progress, artifact_path)
+        chunks = iter_chunks(words)
+        start = 0
+        if mode == 'full':
+            # Chunks before the committed offset are already indexed. Incremental
+            # mode re-reads them instead, and the diff skips them as unchanged.
+            start = progress['offset']
+            chunks = itertools.islice(chunks, start, None)
+        else:
+            progress['offset'] = 0
+        result = index_chunks(document_id, until_deadline(chunks, context, progress), mode=mode, start=start, progress=progress)
+        # Closing the extraction stage flushes the artifact before it is saved
+        words.close()
+
+        if not progress['interrupted']:
+            if state:
+                store.delete(document_id)
+            return {'status': 'succeeded', **result}
+
+        store.save(document_id, {
+            'key': key,
+            'mode': mode,
+            'offset': progress['offset'],
+            'pages_extracted': progress['pages_extracted'],
+            'invocations': (state or {}).get('invocations', 1) + 1
+        }, artifact_path)
+        continuation = {'key': key, 'bucket': bucket, 'mode': mode, 'resume': True}
+        function_name = EMBED_FUNCTION_NAME or getattr(context, 'function_name', None)
+        if CHECKPOINT_CONTINUE == 'invoke' and function_name:
+            LambdaDispatcher(function_name).dispatch(continuation)
+            print(f"Checkpointed {key} at chunk {progress['offset']}, re-invoked {function_name}")
+        return {'status': 'checkpointed', 'continuation': continuation, **result}
+    finally:
+        if os.path.exists(artifact_path):
+            os.remove(artifact_path)
+
+# Process one S3 record, isolating failures so one bad document does not
+# sink the rest of the batch
+def process_record(record, context=None):
+    bucket = record['s3']['bucket']['name']
+    # Object keys in S3 notifications are URL-encoded
+    key = unquote_plus(record['s3']['object']['key'])
+    document_id = re.sub(r'[^a-zA-Z0-9]', '_', key)
+    try:
+        print(f"Processing document from bucket: {bucket}, key: {key}")
+        result = ingest_document(bucket, key, document_id, context=context)
+        return {'key': key, 'document_id': document_id, **result}
+    except Exception as e:
+        print(f"Error processing document {key}: {str(e)}")
+        return {'key': key, 'document_id': document_id, 'status': 'failed', 'error': str(e)}
+
+# Process every record of a (possibly batched) S3 notification with bounded
+# concurrency across documents. Bedrock concurrency stays bounded by the
+# shared embedding controller. Large batches run inside an ingestion session.
+def process_records(records, context=None):
+    create_index_if_not_exists()
+
+    def process_all():
+        with ThreadPoolExecutor(max_workers=max(1, min(DOCUMENT_CONCURRENCY, len(records)))) as executor:
+            return list(executor.map(lambda record: process_record(record, context), records))
+
+    if len(records) >= INGEST_SESSION_MIN_RECORDS:
+        with ingestion_session():
+            results = process_all()
+    else:
+        results = process_all()
+
+    failed = sum(1 for result in results if result['status'] == 'failed')
+    if failed == 0:
+        status_code = 200
+    elif failed == len(results):
+        status_code = 500
+    else:
+        status_code = 207
+
+    print(f"Processed {len(results)} records ({failed} failed)")
+    return {
+        'statusCode': status_code,
+        'body': json.dumps({
+            'results': results,
+            'processed': len(results) - failed,
+            'failed': failed,
+            'embedding_concurrency': embedding_controller.stats(),
+            'embedding_cache': embedding_cache.stats()
+        })
+    }
 
 # Lambda handler
 def lambda_handler(event, context):
     try:
         print(f"Received event: {json.dumps(event)}")
         
-        # Get bucket and key from event
-        if 'Records' in event:  # S3 event notification
-            bucket = event['Records'][0]['s3']['bucket']['name']
-            key = event['Records'][0]['s3']['object']['key']
-        else:  # Direct invocation
-            bucket = os.environ.get('DOCUMENT_BUCKET', 'rag-document-store-ninad-test')
-            key = event.get('key')
+        # S3 event notification: process every record in the batch
+        if 'Records' in event:
+            return process_records(event['Records'], context)
+
+        # Direct invocation
+        bucket = event.get('bucket', DOCUMENT_BUCKET)
+        key = event.get('key')
 
         if not key:
             return {
@@ -176,27 +1807,61 @@ def lambda_handler(event, context):
         # Create index if it doesn't exist
         create_index_if_not_exists()
 
-        # Extract text from document
-        text = extract_text(bucket, key)
-        print(f"Extracted text (first 100 chars): {text[:100]}")
-
-        # Chunk the text
-        chunks = chunk_text(text)
-        print(f"Created {len(chunks)} chunks")
-
         # Generate document ID from the key
         document_id = re.sub(r'[^a-zA-Z0-9]', '_', key)
 
-        # Index chunks to OpenSearch
-        index_chunks(document_id, chunks)
+        # Coordinator: split the document and dispatch page-range workers
+        if event.get('fan_out'):
+            plan = start_fan_out(bucket, key, document_id, int(event['fan_out']), context)
+            return {
+                'statusCode': 202,
+                'body': json.dumps({
+                    'message': f'Dispatched fan-out ingestion for {key}',
+                    **plan
+                })
+            }
+
+        # Worker: index a single page range
+        if 'page_start' in event:
+            result = process_page_range(
+                bucket, key, document_id,
+                int(event['page_start']), int(event['page_end']),
+                event.get('run_id')
+            )
+        else:
+            # Stream words from the document into overlapping chunks and index
+            # them, checkpointing if the invocation runs short of time
+            result = ingest_document(
+                bucket, key, document_id,
+                mode=event.get('mode'), context=context, resume=event.get('resume', False)
+            )
+            if result['status'] == 'checkpointed':
+                return {
+                    'statusCode': 202,
+                    'body': json.dumps({
+                        'message': f'Checkpointed document {key} before timeout',
+                        'document_id': document_id,
+                        **result
+                    })
+                }
 
         return {
             'statusCode': 200,
-            'body': json.dumps(f'Successfully processed document {key}')
+            'body': json.dumps({
+                'message': f'Successfully processed document {key}',
+                'document_id': document_id,
+                **result,
+                'embedding_concurrency': embedding_controller.stats(),
+                'embedding_cache': embedding_cache.stats()
+            })
         }
 
     except Exception as e:
         print(f"Error: {str(e)}")
+        # A fan-out worker runs as an asynchronous invocation, which Lambda
+        # only retries if the handler raises
+        if 'page_start' in event and event.get('run_id'):
+            raise
         return {
             'statusCode': 500,
             'body': json.dumps(f'Error processing document: {str(e)}')
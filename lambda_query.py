@@ -1,6 +1,18 @@
 import boto3
 import json
 import os
+import re
+import hashlib
+import itertools
+import math
+import operator
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
 
@@ -10,7 +22,7 @@ region = os.environ['REGION']  # Changed from AWS_REGION to REGION
 
 # OpenSearch configuration
 host = os.environ['OPENSEARCH_ENDPOINT']
-index_name = 'document_embeddings'
+index_name = os.environ.get('INDEX_NAME', 'document_embeddings')
 credentials = boto3.Session().get_credentials()
 awsauth = AWS4Auth(credentials.access_key, credentials.secret_key,
                   region, 'es', session_token=credentials.token)
@@ -24,177 +36,1408 @@ opensearch = OpenSearch(
     connection_class=RequestsHttpConnection
 )
 
-# Generate embeddings using Amazon Bedrock
-def generate_embedding(text):
-    try:
-        model_id = "amazon.titan-embed-text-v2:0"  # Updated model ID
-        body = json.dumps({"inputText": text})
+# Embedding model configuration
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"  # Updated model ID
+# Titan Text Embeddings V2 returns normalized vectors of 256, 512 or 1024
+# dimensions; the index mapping is created with the same dimension
+EMBEDDING_DIMENSION = int(os.environ.get('EMBEDDING_DIMENSION', '1024'))
+if EMBEDDING_DIMENSION not in (256, 512, 1024):
+    raise ValueError(f"Unsupported EMBEDDING_DIMENSION {EMBEDDING_DIMENSION}; use 256, 512 or 1024")
 
-        response = bedrock_runtime.invoke_model(
-            modelId=model_id,
-            body=body
+# Vector storage profile for the knn_vector field: 'float' (float32),
+# 'fp16' (faiss HNSW with SQfp16 encoding) or 'byte' (signed 8-bit values,
+# scalar-quantized client-side from the normalized Titan output)
+VECTOR_STORAGE = os.environ.get('VECTOR_STORAGE', 'float')
+if VECTOR_STORAGE not in ('float', 'fp16', 'byte'):
+    raise ValueError(f"Unsupported VECTOR_STORAGE {VECTOR_STORAGE}; use float, fp16 or byte")
+# Components of normalized vectors beyond +/- this range are clipped when
+# quantizing to bytes
+BYTE_QUANTIZATION_RANGE = float(os.environ.get('BYTE_QUANTIZATION_RANGE', '0.25'))
+
+# Retrieval defaults for this endpoint; requests may override top_k, k
+# (neighbours retrieved by the kNN search) and ef_search within the limits
+DEFAULT_TOP_K = int(os.environ.get('DEFAULT_TOP_K', '3'))
+DEFAULT_EF_SEARCH = int(os.environ['DEFAULT_EF_SEARCH']) if os.environ.get('DEFAULT_EF_SEARCH') else None
+MAX_TOP_K = int(os.environ.get('MAX_TOP_K', '50'))
+MAX_EF_SEARCH = int(os.environ.get('MAX_EF_SEARCH', '1000'))
+# ef_search is sent per query as the k-NN plugin's method_parameters, which
+# OpenSearch accepts from 2.16. Older clusters reject the kNN search, so
+# requests setting ef_search get a 400 there and DEFAULT_EF_SEARCH is not
+# sent: the index-level knn.algo_param.ef_search applies instead.
+MIN_QUERY_EF_SEARCH_VERSION = (2, 16)
+
+# Only these fields are fetched for each hit; the vector never leaves the index
+SEARCH_SOURCE_FIELDS = ['text', 'document_id', 'chunk_id', 'metadata']
+
+# Retrieval mode: 'knn' (vector search only) or 'hybrid' (BM25 match on text
+# and kNN in one msearch round trip, fused client-side). Hybrid results are
+# fused by reciprocal rank ('rrf') or by min-max normalized scores
+# ('weighted'); requests may override mode, fusion and weights.
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'knn')
+if SEARCH_MODE not in ('knn', 'hybrid'):
+    raise ValueError(f"Unsupported SEARCH_MODE {SEARCH_MODE}; use knn or hybrid")
+FUSION_METHOD = os.environ.get('FUSION_METHOD', 'rrf')
+if FUSION_METHOD not in ('rrf', 'weighted'):
+    raise ValueError(f"Unsupported FUSION_METHOD {FUSION_METHOD}; use rrf or weighted")
+DEFAULT_FUSION_WEIGHTS = {
+    'bm25': float(os.environ.get('BM25_WEIGHT', '1.0')),
+    'knn': float(os.environ.get('KNN_WEIGHT', '1.0'))
+}
+RRF_RANK_CONSTANT = int(os.environ.get('RRF_RANK_CONSTANT', '60'))
+
+# Maximal Marginal Relevance re-ranking. Searches over-fetch MMR_FETCH_K
+# candidates with their vectors, and top_k of them are selected trading
+# relevance against similarity to chunks already selected: MMR_LAMBDA 1.0 is
+# pure relevance, lower values favour diversity. Requests may override mmr,
+# mmr_lambda and fetch_k.
+MMR_ENABLED = os.environ.get('MMR_ENABLED', 'true').lower() == 'true'
+MMR_FETCH_K = int(os.environ.get('MMR_FETCH_K', '30'))
+MMR_LAMBDA = float(os.environ.get('MMR_LAMBDA', '0.5'))
+
+# Context assembly. Retrieved chunks that are adjacent in their document are
+# merged into one span with the overlapping words stripped, and spans are
+# packed in relevance order up to CONTEXT_TOKEN_BUDGET estimated tokens.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '3000'))
+# Ingestion overlaps consecutive chunks by 100 words; overlaps up to this
+# length are detected
+MAX_OVERLAP_WORDS = 250
+# Rough characters per token for English text, used to estimate prompt size
+CHARS_PER_TOKEN = 4
+# Extractive compression ('extractive' or 'none'). Span text is split into
+# sentences scored by idf-weighted overlap with the query terms; sentences
+# scoring below EXTRACTIVE_MIN_SCORE of the best one are dropped unless they
+# neighbour a matching sentence, and the rest are packed by score.
+CONTEXT_COMPRESSION = os.environ.get('CONTEXT_COMPRESSION', 'extractive')
+if CONTEXT_COMPRESSION not in ('extractive', 'none'):
+    raise ValueError(f"Unsupported CONTEXT_COMPRESSION {CONTEXT_COMPRESSION}; use extractive or none")
+EXTRACTIVE_MIN_SCORE = float(os.environ.get('EXTRACTIVE_MIN_SCORE', '0.2'))
+# Share of a matching sentence's score given to the sentences beside it
+NEIGHBOUR_WEIGHT = 0.5
+# PDF text often lacks punctuation, so longer sentences are cut into pieces
+MAX_SENTENCE_WORDS = 60
+# Words too common to count as overlap with the query
+STOPWORDS = frozenset(
+    'a an and are as at be by can do does for from how i in is it of on or the this that to was were '
+    'what when where which who why will with you your'.split()
+)
+
+# Semantic answer cache. A query whose embedding has cosine similarity of at
+# least ANSWER_CACHE_THRESHOLD to a cached query asked with the same
+# retrieval parameters gets the cached answer. Entries belong to an index
+# generation, re-read at most every ANSWER_CACHE_GENERATION_TTL seconds, and
+# are dropped when it advances. ANSWER_CACHE_SIZE 0 disables the cache.
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', '500'))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_GENERATION_TTL = float(os.environ.get('ANSWER_CACHE_GENERATION_TTL', '10'))
+
+# Batch requests ({"queries": [...]}) answer up to MAX_BATCH_QUERIES queries
+# in one invocation: they are embedded BATCH_EMBEDDING_CONCURRENCY at a time,
+# searched in a single msearch and answered BATCH_GENERATION_CONCURRENCY at a
+# time. Both stay within the Bedrock client's default pool of 10 connections.
+MAX_BATCH_QUERIES = int(os.environ.get('MAX_BATCH_QUERIES', '20'))
+BATCH_EMBEDDING_CONCURRENCY = int(os.environ.get('BATCH_EMBEDDING_CONCURRENCY', '8'))
+BATCH_GENERATION_CONCURRENCY = int(os.environ.get('BATCH_GENERATION_CONCURRENCY', '4'))
+
+# Script field that reads the stored vector from doc values, since the
+# embedding is excluded from _source
+EMBEDDING_SCRIPT_FIELDS = {
+    'embedding': {
+        'script': {
+            'lang': 'painless',
+            'source': "doc['embedding'].size() == 0 ? null : doc['embedding'].value"
+        }
+    }
+}
+
+# Query embedding cache configuration. Backends: 'memory' (per-container
+# LRU living at module scope, so it survives warm invocations), 'sqlite' (LRU
+# in front of a local SQLite file) or 'none'. The LRU is bounded by entry
+# count and by bytes, and entries expire after EMBEDDING_CACHE_TTL seconds
+# (0 keeps them until evicted). EMBEDDING_CACHE_SNAPSHOT names a JSON-lines
+# file, written by rag_admin.py seed-query-cache, that seeds the cache at
+# cold start.
+EMBEDDING_CACHE_BACKEND = os.environ.get('EMBEDDING_CACHE_BACKEND', 'memory')
+EMBEDDING_CACHE_SIZE = int(os.environ.get('EMBEDDING_CACHE_SIZE', '2000'))
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+EMBEDDING_CACHE_TTL = int(os.environ.get('EMBEDDING_CACHE_TTL', '86400'))
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', '/tmp/embedding_cache.sqlite3')
+EMBEDDING_CACHE_SNAPSHOT = os.environ.get('EMBEDDING_CACHE_SNAPSHOT')
+
+# In-memory LRU+TTL store holding vectors compactly as float32 arrays
+class LRUEmbeddingStore:
+    def __init__(self, max_entries, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(key, vector):
+        return len(key) + vector.itemsize * len(vector)
+
+    def _remove(self, key):
+        vector, _ = self._entries.pop(key)
+        self.bytes -= self._size(key, vector)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return vector.tolist()
+
+    def put(self, key, embedding):
+        vector = array('f', embedding)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (vector, time.time() + self.ttl if self.ttl else None)
+            self.bytes += self._size(key, vector)
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Unexpired entries, least recently used first
+    def items(self):
+        now = time.time()
+        with self._lock:
+            return [(key, vector.tolist()) for key, (vector, expires_at) in self._entries.items()
+                    if expires_at is None or expires_at > now]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+# SQLite-backed store standing in for a persistent cache
+class SQLiteEmbeddingStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)'
         )
+        self._conn.commit()
 
-        response_body = json.loads(response['body'].read())
-        embedding = response_body.get('embedding')
-        
-        if not embedding:
-            print(f"Warning: No embedding returned for text: {text[:50]}...")
-            # Return a default embedding of zeros as fallback
-            return [0.0] * 1536
-            
-        return embedding
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT vector FROM embeddings WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        vector = array('f')
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def put(self, key, embedding):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                (key, array('f', embedding).tobytes())
+            )
+            self._conn.commit()
+
+# Content-addressed embedding cache checked before calling Bedrock. Stores
+# are consulted in order and earlier tiers are back-filled on a hit.
+class EmbeddingCache:
+    def __init__(self, stores):
+        self.stores = stores
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text, model_id, dimension):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{model_id}:{dimension}:{digest}"
+
+    def get(self, key):
+        for tier, store in enumerate(self.stores):
+            embedding = store.get(key)
+            if embedding is not None:
+                for earlier in self.stores[:tier]:
+                    earlier.put(key, embedding)
+                with self._lock:
+                    self.hits += 1
+                return embedding
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, embedding):
+        for store in self.stores:
+            store.put(key, embedding)
+
+    # Write the first tier's entries as JSON lines of {"key", "embedding"}
+    def save_snapshot(self, path):
+        items = self.stores[0].items() if self.stores else []
+        with open(path, 'w') as f:
+            for key, embedding in items:
+                f.write(json.dumps({'key': key, 'embedding': embedding}) + '\n')
+        return len(items)
+
+    # Seed the first tier from a snapshot. Keys embed the model and dimension,
+    # so entries from a differently configured snapshot are never hit.
+    def load_snapshot(self, path):
+        if not self.stores:
+            return 0
+        loaded = 0
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.stores[0].put(entry['key'], entry['embedding'])
+                    loaded += 1
+        return loaded
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+        if self.stores and hasattr(self.stores[0], 'stats'):
+            stats.update(self.stores[0].stats())
+        return stats
+
+# Build the embedding cache for the configured backend, seeded from the
+# snapshot if one is configured
+def create_embedding_cache():
+    if EMBEDDING_CACHE_BACKEND == 'none':
+        return EmbeddingCache([])
+    stores = [LRUEmbeddingStore(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_MAX_BYTES, EMBEDDING_CACHE_TTL)]
+    if EMBEDDING_CACHE_BACKEND == 'sqlite':
+        stores.append(SQLiteEmbeddingStore(EMBEDDING_CACHE_PATH))
+    cache = EmbeddingCache(stores)
+    if EMBEDDING_CACHE_SNAPSHOT:
+        try:
+            print(f"Seeded embedding cache with {cache.load_snapshot(EMBEDDING_CACHE_SNAPSHOT)} entries")
+        except (OSError, ValueError, KeyError) as e:
+            # A missing or damaged snapshot only costs cache hits
+            print(f"Could not load embedding cache snapshot {EMBEDDING_CACHE_SNAPSHOT}: {str(e)}")
+    return cache
+
+embedding_cache = create_embedding_cache()
+
+# Normalize query text so trivially different phrasings of a question share
+# one cache entry: Unicode NFKC, collapsed whitespace and lower case
+def normalize_query(text):
+    return ' '.join(unicodedata.normalize('NFKC', text).split()).lower()
+
+# Single-flight coalescing: the first caller for a key runs the work and
+# callers arriving with the same key while it is in flight await its future
+# instead of repeating the work. The coalescing ratio is the share of calls
+# that were answered by another caller's work.
+class SingleFlight:
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    # Join the call in flight for key, or lead a new one. Returns
+    # (future, leader); a leader must settle the future with finish.
+    def join(self, key):
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._futures[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    # Run fn as the single call in flight for key. Returns (result, coalesced);
+    # an error raised by the leader's fn is raised to every caller.
+    def do(self, key, fn):
+        future, leader = self.join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            return {
+                'calls': calls,
+                'coalesced': self.coalesced,
+                'coalescing_ratio': round(self.coalesced / calls, 4) if calls else 0.0,
+                'in_flight': len(self._futures)
+            }
+
+# Bedrock embedding calls, keyed by embedding cache key
+embedding_flights = SingleFlight()
+# Whole answers to non-streamed queries and the retrievals of streamed ones,
+# keyed by query_key
+query_flights = SingleFlight()
+retrieval_flights = SingleFlight()
+
+def coalescing_stats():
+    return {
+        'embedding': embedding_flights.stats(),
+        'query': query_flights.stats(),
+        'retrieval': retrieval_flights.stats()
+    }
+
+# Generate embeddings using Amazon Bedrock. Concurrent misses for the same
+# text share one Bedrock call.
+def generate_embedding(text):
+    try:
+        cache_key = EmbeddingCache.make_key(text, EMBEDDING_MODEL_ID, EMBEDDING_DIMENSION)
+        embedding = embedding_cache.get(cache_key)
+        if embedding is not None:
+            return embedding
+        return embedding_flights.do(cache_key, lambda: invoke_embedding_model(text, cache_key))[0]
     except Exception as e:
         print(f"Error generating embedding: {str(e)}")
         # Return a default embedding of zeros as fallback
-        return [0.0] * 1536
+        return [0.0] * EMBEDDING_DIMENSION
 
-# Search OpenSearch for relevant chunks
-def search_documents(query_embedding, top_k=3):
-    try:
-        # Make sure the embedding dimension matches the index configuration (1536)
-        if len(query_embedding) != 1536:
-            # Pad or truncate to match required dimension
-            if len(query_embedding) < 1536:
-                query_embedding = query_embedding + [0.0] * (1536 - len(query_embedding))
-            else:
-                query_embedding = query_embedding[:1536]
+# Embed text with Bedrock and cache the embedding under cache_key
+def invoke_embedding_model(text, cache_key):
+    model_id = EMBEDDING_MODEL_ID
+    body = json.dumps({
+        "inputText": text,
+        "dimensions": EMBEDDING_DIMENSION,
+        "normalize": True
+    })
+
+    response = bedrock_runtime.invoke_model(
+        modelId=model_id,
+        body=body
+    )
+
+    response_body = json.loads(response['body'].read())
+    embedding = response_body.get('embedding')
+    
+    if not embedding:
+        print(f"Warning: No embedding returned for text: {text[:50]}...")
+        # Return a default embedding of zeros as fallback
+        return [0.0] * EMBEDDING_DIMENSION
         
-        search_query = {
-            "size": top_k,
-            "query": {
-                "knn": {
-                    "embedding": {
-                        "vector": query_embedding,
-                        "k": top_k
-                    }
-                }
+    embedding_cache.put(cache_key, embedding)
+    return embedding
+
+# Scalar-quantize a normalized vector to signed bytes for 'byte' storage
+def quantize_to_bytes(vector):
+    scale = 127 / BYTE_QUANTIZATION_RANGE
+    return [max(-128, min(127, round(x * scale))) for x in vector]
+
+# The cluster's (major, minor) version, read once per container, or None if
+# it can't be read
+_cluster_version = None
+
+def cluster_version():
+    global _cluster_version
+    if _cluster_version is None:
+        try:
+            number = opensearch.info()['version']['number']
+        except Exception as e:
+            print(f"Could not read the cluster version: {str(e)}")
+            return None
+        _cluster_version = tuple(int(part) for part in re.findall(r'\d+', number)[:2])
+        if DEFAULT_EF_SEARCH and _cluster_version < MIN_QUERY_EF_SEARCH_VERSION:
+            print(f"OpenSearch {number} doesn't accept per-query ef_search; ignoring DEFAULT_EF_SEARCH")
+    return _cluster_version
+
+def supports_query_ef_search():
+    version = cluster_version()
+    return version is not None and version >= MIN_QUERY_EF_SEARCH_VERSION
+
+# Read the optional ef_search request parameter, falling back to
+# DEFAULT_EF_SEARCH where the cluster accepts it per query
+def parse_ef_search(body):
+    ef_search = parse_search_parameter(body, 'ef_search', None, MAX_EF_SEARCH)
+    if ef_search is not None:
+        if not supports_query_ef_search():
+            version = '.'.join(map(str, MIN_QUERY_EF_SEARCH_VERSION))
+            raise ValueError(f"'ef_search' needs OpenSearch {version} or later; "
+                             f"this cluster uses the index's ef_search setting")
+        return ef_search
+    if DEFAULT_EF_SEARCH and supports_query_ef_search():
+        return DEFAULT_EF_SEARCH
+    return None
+
+# Read an optional positive integer request parameter bounded by maximum
+def parse_search_parameter(body, name, default, maximum):
+    value = body.get(name, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= maximum:
+        raise ValueError(f"'{name}' must be an integer between 1 and {maximum}")
+    return value
+
+# Read an optional number request parameter within [minimum, maximum]
+def parse_fraction(body, name, default, minimum=0.0, maximum=1.0):
+    value = body.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not minimum <= value <= maximum:
+        raise ValueError(f"'{name}' must be a number between {minimum} and {maximum}")
+    return float(value)
+
+# Read the optional fusion weights of a hybrid request, defaulting any
+# retriever the request leaves out
+def parse_fusion_weights(body):
+    weights = body.get('weights')
+    if weights is None:
+        return dict(DEFAULT_FUSION_WEIGHTS)
+    if not isinstance(weights, dict) or not set(weights) <= set(DEFAULT_FUSION_WEIGHTS):
+        raise ValueError(f"'weights' must be an object with keys {sorted(DEFAULT_FUSION_WEIGHTS)}")
+    for name, weight in weights.items():
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight < 0:
+            raise ValueError(f"'weights.{name}' must be a non-negative number")
+    return {**DEFAULT_FUSION_WEIGHTS, **weights}
+
+# Read an optional request parameter restricted to a set of choices
+def parse_choice(body, name, default, choices):
+    value = body.get(name, default)
+    if value not in choices:
+        raise ValueError(f"'{name}' must be one of {', '.join(choices)}")
+    return value
+
+# Build the kNN query body. k is the number of neighbours retrieved and
+# ef_search overrides the HNSW candidate list size for this query only.
+def build_knn_search(query_embedding, size, k, ef_search=None, with_vectors=False):
+    # A byte index is searched with a query quantized the same way
+    if VECTOR_STORAGE == 'byte':
+        query_embedding = quantize_to_bytes(query_embedding)
+
+    knn_query = {
+        "vector": query_embedding,
+        "k": k
+    }
+    if ef_search:
+        knn_query["method_parameters"] = {"ef_search": ef_search}
+
+    search = {
+        "size": size,
+        "_source": {"includes": SEARCH_SOURCE_FIELDS},
+        "query": {
+            "knn": {
+                "embedding": knn_query
+            }
+        }
+    }
+    if with_vectors:
+        search["script_fields"] = EMBEDDING_SCRIPT_FIELDS
+    return search
+
+# Build the BM25 query body matching the query text against chunk text
+def build_bm25_search(query_text, size, with_vectors=False):
+    search = {
+        "size": size,
+        "_source": {"includes": SEARCH_SOURCE_FIELDS},
+        "query": {
+            "match": {
+                "text": query_text
             }
         }
+    }
+    if with_vectors:
+        search["script_fields"] = EMBEDDING_SCRIPT_FIELDS
+    return search
 
+# Convert search hits to result chunks, keeping the stored vector when the
+# search asked for it
+def hits_to_results(hits):
+    results = []
+    for hit in hits:
+        result = {
+            'text': hit['_source']['text'],
+            'score': hit['_score'],
+            'document_id': hit['_source']['document_id'],
+            'chunk_id': hit['_source']['chunk_id'],
+            'metadata': hit['_source'].get('metadata', {})
+        }
+        values = hit.get('fields', {}).get('embedding')
+        if values:
+            result['vector'] = values[0] if isinstance(values[0], list) else values
+        results.append(result)
+    return results
+
+def dot(a, b):
+    return sum(map(operator.mul, a, b))
+
+def unit_vector(vector):
+    norm = math.sqrt(dot(vector, vector)) or 1.0
+    return [x / norm for x in vector]
+
+# Select top_k candidates by Maximal Marginal Relevance, maximizing
+# mmr_lambda * sim(query, c) - (1 - mmr_lambda) * max(sim(c, s) for selected s)
+# with cosine similarity. Without NumPy in the package a full similarity
+# matrix costs fetch_k^2 dot products, so only the rows of selected chunks
+# are computed, each folded into a running max similarity per candidate.
+def mmr_select(query_embedding, candidates, top_k, mmr_lambda=MMR_LAMBDA):
+    if len(candidates) <= top_k or any('vector' not in candidate for candidate in candidates):
+        return candidates[:top_k]
+
+    query = unit_vector(query_embedding)
+    vectors = [unit_vector(candidate['vector']) for candidate in candidates]
+    relevance = [dot(query, vector) for vector in vectors]
+    redundancy = [0.0] * len(candidates)
+    remaining = set(range(len(candidates)))
+    selected = []
+    while remaining and len(selected) < top_k:
+        best = max(remaining, key=lambda i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * redundancy[i])
+        remaining.discard(best)
+        selected.append(best)
+        for i in remaining:
+            similarity = dot(vectors[best], vectors[i])
+            redundancy[i] = similarity if len(selected) == 1 else max(redundancy[i], similarity)
+    return [candidates[i] for i in selected]
+
+# Fuse ranked result lists, keyed by retriever name, into one ranking.
+# 'rrf' scores a chunk by sum(weight / (RRF_RANK_CONSTANT + rank)); 'weighted'
+# min-max normalizes each list's scores and sums them by weight.
+def fuse_results(ranked, weights, method='rrf'):
+    fused = {}
+    chunks = {}
+    for name, results in ranked.items():
+        weight = weights.get(name, 0.0)
+        if not results or not weight:
+            continue
+        scores = [result['score'] for result in results]
+        low, high = min(scores), max(scores)
+        for rank, result in enumerate(results, 1):
+            chunk_id = result['chunk_id']
+            chunks.setdefault(chunk_id, result)
+            if method == 'rrf':
+                contribution = weight / (RRF_RANK_CONSTANT + rank)
+            else:
+                contribution = weight * ((result['score'] - low) / (high - low) if high > low else 1.0)
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + contribution
+
+    ordered = sorted(fused, key=fused.get, reverse=True)
+    return [{**chunks[chunk_id], 'score': fused[chunk_id]} for chunk_id in ordered]
+
+# Plan the searches answering one query, by retriever name. k is the number
+# of candidates each retriever returns (at least top_k) and ef_search
+# overrides the HNSW candidate list size for this query only. Hybrid mode also
+# matches query_text with BM25, to be fused with the kNN ranking. With MMR,
+# fetch_k candidates are retrieved and top_k of them selected for diversity.
+def plan_searches(query_embedding, top_k=DEFAULT_TOP_K, k=None, ef_search=None,
+                  query_text=None, mode=SEARCH_MODE, fusion=FUSION_METHOD, weights=None,
+                  mmr=MMR_ENABLED, mmr_lambda=MMR_LAMBDA, fetch_k=MMR_FETCH_K):
+    size = max(fetch_k, top_k) if mmr else top_k
+    k = max(k or size, size)
+
+    # The query vector must match the dimension the index was created with
+    if len(query_embedding) != EMBEDDING_DIMENSION:
+        raise ValueError(f"Query embedding dimension {len(query_embedding)} doesn't match expected {EMBEDDING_DIMENSION}")
+
+    if mode == 'hybrid' and query_text:
+        searches = {
+            'bm25': build_bm25_search(query_text, k, mmr),
+            'knn': build_knn_search(query_embedding, k, k, ef_search, mmr)
+        }
+    else:
+        mode = 'knn'
+        searches = {'knn': build_knn_search(query_embedding, size, k, ef_search, mmr)}
+    return {
+        'query_embedding': query_embedding,
+        'query_text': query_text,
+        'mode': mode,
+        'searches': searches,
+        'size': size,
+        'top_k': top_k,
+        'fusion': fusion,
+        'weights': weights,
+        'mmr': mmr,
+        'mmr_lambda': mmr_lambda
+    }
+
+# Rank the msearch responses to a plan's searches. Hybrid rankings are fused,
+# and a retriever that fails is dropped from the fusion rather than failing
+# the query.
+def rank_search_results(plan, responses):
+    ranked = {}
+    for name, item in zip(plan['searches'], responses):
+        if 'error' in item:
+            print(f"{name} search failed: {item['error']}")
+            continue
+        ranked[name] = hits_to_results(item['hits']['hits'])
+    if not ranked:
+        raise RuntimeError(f"Every {plan['mode']} retriever failed")
+
+    if plan['mode'] == 'hybrid':
+        print(f"Hybrid candidates: {', '.join(f'{name}={len(results)}' for name, results in ranked.items())}")
+        results = fuse_results(ranked, plan['weights'] or DEFAULT_FUSION_WEIGHTS, plan['fusion'])[:plan['size']]
+    else:
+        results = ranked['knn']
+
+    if plan['mmr']:
+        results = mmr_select(plan['query_embedding'], results, plan['top_k'], plan['mmr_lambda'])
+        print(f"MMR selected {len(results)} of {plan['size']} candidates (lambda {plan['mmr_lambda']})")
+    # Vectors were only needed for re-ranking
+    for result in results:
+        result.pop('vector', None)
+
+    print(f"Found {len(results)} relevant chunks")
+    if results:
+        print(f"Top result (first 100 chars): {results[0]['text'][:100]}")
+    return results
+
+# Keyword match on the query text, or the first documents without one
+def fallback_search(query_text, top_k):
+    fallback_query = build_bm25_search(query_text, top_k) if query_text else {
+        "size": top_k,
+        "_source": {"includes": SEARCH_SOURCE_FIELDS},
+        "query": {
+            "match_all": {}
+        }
+    }
+    response = opensearch.search(
+        body=fallback_query,
+        index=index_name
+    )
+    return hits_to_results(response['hits']['hits'])
+
+# Run the searches of every plan in one msearch round trip and rank each
+# plan's results. A plan whose searches fail falls back to fallback_search,
+# and one whose fallback fails too gets no results.
+def execute_searches(plans):
+    body = []
+    for plan in plans:
+        for search in plan['searches'].values():
+            body.extend([{"index": index_name}, search])
+    try:
+        responses = iter(opensearch.msearch(body=body)['responses'])
+    except Exception as e:
+        print(f"msearch of {len(plans)} queries failed: {str(e)}")
+        responses = None
+
+    results = []
+    for plan in plans:
         try:
-            response = opensearch.search(
-                body=search_query,
-                index=index_name
-            )
-            results = []
-            for hit in response['hits']['hits']:
-                results.append({
-                    'text': hit['_source']['text'],
-                    'score': hit['_score'],
-                    'document_id': hit['_source']['document_id'],
-                    'chunk_id': hit['_source']['chunk_id']
-                })
-            
-            print(f"Found {len(results)} relevant chunks")
-            if results:
-                print(f"Top result (first 100 chars): {results[0]['text'][:100]}")
-                
-            return results
+            if responses is None:
+                raise RuntimeError('msearch failed')
+            results.append(rank_search_results(plan, list(itertools.islice(responses, len(plan['searches'])))))
         except Exception as e:
-            print(f"KNN search failed: {str(e)}")
-            # Fall back to match_all query
-            fallback_query = {
-                "size": top_k,
-                "query": {
-                    "match_all": {}
-                }
-            }
-            response = opensearch.search(
-                body=fallback_query,
-                index=index_name
-            )
-            results = []
-            for hit in response['hits']['hits']:
-                results.append({
-                    'text': hit['_source']['text'],
-                    'score': hit['_score'],
-                    'document_id': hit['_source']['document_id'],
-                    'chunk_id': hit['_source']['chunk_id']
-                })
-            return results
+            print(f"{plan['mode']} search failed: {str(e)}")
+            try:
+                results.append(fallback_search(plan['query_text'], plan['top_k']))
+            except Exception as e:
+                print(f"Search error: {str(e)}")
+                results.append([])
+    return results
+
+# Search OpenSearch for the chunks relevant to one query; see plan_searches
+def search_documents(query_embedding, top_k=DEFAULT_TOP_K, k=None, ef_search=None,
+                     query_text=None, mode=SEARCH_MODE, fusion=FUSION_METHOD, weights=None,
+                     mmr=MMR_ENABLED, mmr_lambda=MMR_LAMBDA, fetch_k=MMR_FETCH_K):
+    try:
+        plan = plan_searches(query_embedding, top_k, k, ef_search, query_text, mode, fusion, weights,
+                             mmr, mmr_lambda, fetch_k)
     except Exception as e:
         print(f"Search error: {str(e)}")
         return []
+    return execute_searches([plan])[0]
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+# Number of words at the end of previous that repeat at the start of following
+def overlap_length(previous, following):
+    for size in range(min(len(previous), len(following), MAX_OVERLAP_WORDS), 0, -1):
+        if previous[-size:] == following[:size]:
+            return size
+    return 0
+
+# Merge retrieved chunks into contiguous spans ordered by relevance. Chunks
+# of the same document (and fan-out page range, which numbers its chunks
+# separately) with consecutive chunk numbers form one span, with the overlap
+# between them stripped; a span ranks by its most relevant chunk.
+def merge_spans(chunks):
+    groups = {}
+    for rank, chunk in enumerate(chunks):
+        metadata = chunk.get('metadata', {})
+        key = (chunk['document_id'], metadata.get('page_start'))
+        groups.setdefault(key, []).append((metadata.get('chunk_number'), rank, chunk))
+
+    spans = []
+    for (document_id, _), members in groups.items():
+        # Chunks without a position cannot be merged
+        positioned = sorted((m for m in members if m[0] is not None), key=lambda m: m[0])
+        unpositioned = [m for m in members if m[0] is None]
+        span = None
+        for chunk_number, rank, chunk in positioned:
+            words = chunk['text'].split()
+            if span and chunk_number <= span['chunk_numbers'][-1] + 1:
+                if chunk_number > span['chunk_numbers'][-1]:
+                    span['words'].extend(words[overlap_length(span['words'], words):])
+                    span['chunk_numbers'].append(chunk_number)
+                span['rank'] = min(span['rank'], rank)
+            else:
+                span = {'document_id': document_id, 'chunk_numbers': [chunk_number], 'words': words, 'rank': rank}
+                spans.append(span)
+        for _, rank, chunk in unpositioned:
+            spans.append({'document_id': document_id, 'chunk_numbers': [], 'words': chunk['text'].split(), 'rank': rank})
+    return sorted(spans, key=lambda span: span['rank'])
+
+# Pack whole spans in relevance order within token_budget. Spans that don't
+# fit are skipped, except that the most relevant span is truncated rather
+# than dropped.
+def pack_spans(spans, token_budget):
+    packed = []
+    remaining = token_budget
+    for span in spans:
+        text = ' '.join(span['words'])
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            if packed:
+                continue
+            text = text[:remaining * CHARS_PER_TOKEN]
+            tokens = estimate_tokens(text)
+        packed.append({
+            'document_id': span['document_id'],
+            'chunk_numbers': span['chunk_numbers'],
+            'text': text,
+            'tokens': tokens
+        })
+        remaining -= tokens
+    return packed
+
+# Lower-cased words of text that can match query terms
+def lexical_terms(text):
+    return [term for term in re.findall(r'\w+', text.lower())
+            if term not in STOPWORDS and (len(term) > 1 or term.isdigit())]
+
+# Split span words into sentences of at most MAX_SENTENCE_WORDS words
+def split_sentences(words):
+    sentences, current = [], []
+    for word in words:
+        current.append(word)
+        if word[-1] in '.!?' or len(current) >= MAX_SENTENCE_WORDS:
+            sentences.append(' '.join(current))
+            current = []
+    if current:
+        sentences.append(' '.join(current))
+    return sentences
+
+# Pack the sentences of the spans that best match the query within
+# token_budget, keeping them in document order within each span and marking
+# gaps with an ellipsis. Returns None when no sentence shares a term with the
+# query, since the chunks were then retrieved on meaning alone.
+def compress_spans(query, spans, token_budget):
+    query_terms = set(lexical_terms(query))
+    sentences = []
+    for span_index, span in enumerate(spans):
+        for position, sentence in enumerate(split_sentences(span['words'])):
+            sentences.append({
+                'span': span_index,
+                'position': position,
+                'text': sentence,
+                'terms': set(lexical_terms(sentence)) & query_terms
+            })
+
+    frequencies = Counter(term for sentence in sentences for term in sentence['terms'])
+    if not frequencies:
+        return None
+    # Terms found in few sentences discriminate best
+    idf = {term: math.log(1 + len(sentences) / count) for term, count in frequencies.items()}
+    overlap = [sum(idf[term] for term in sentence['terms']) for sentence in sentences]
+    best = max(overlap)
+
+    scores = []
+    for i, sentence in enumerate(sentences):
+        neighbours = [overlap[j] for j in (i - 1, i + 1)
+                      if 0 <= j < len(sentences) and sentences[j]['span'] == sentence['span']]
+        score = max([overlap[i]] + [NEIGHBOUR_WEIGHT * value for value in neighbours]) / best
+        scores.append(score)
+
+    # Ties go to sentences of more relevant spans
+    ranked = sorted((i for i, score in enumerate(scores) if score >= EXTRACTIVE_MIN_SCORE),
+                    key=lambda i: (-scores[i], sentences[i]['span'], sentences[i]['position']))
+    selected = []
+    remaining = token_budget
+    for i in ranked:
+        tokens = estimate_tokens(sentences[i]['text']) + 1
+        if tokens <= remaining:
+            selected.append(i)
+            remaining -= tokens
+    if not selected:
+        return None
+
+    packed = []
+    for span_index in sorted({sentences[i]['span'] for i in selected}):
+        span = spans[span_index]
+        members = sorted((sentences[i] for i in selected if sentences[i]['span'] == span_index),
+                         key=lambda sentence: sentence['position'])
+        text = members[0]['text'] if members[0]['position'] == 0 else '... ' + members[0]['text']
+        for previous, sentence in zip(members, members[1:]):
+            text += (' ' if sentence['position'] == previous['position'] + 1 else ' ... ') + sentence['text']
+        packed.append({
+            'document_id': span['document_id'],
+            'chunk_numbers': span['chunk_numbers'],
+            'text': text,
+            'tokens': estimate_tokens(text)
+        })
+    return packed
+
+# Build the LLM context from retrieved chunks: merge them into spans, then
+# pack the query's best-matching sentences (or, without a query or lexical
+# match, whole spans) within token_budget
+def assemble_context(chunks, token_budget=CONTEXT_TOKEN_BUDGET, query=None):
+    spans = merge_spans(chunks)
+    packed = None
+    if query and CONTEXT_COMPRESSION == 'extractive':
+        packed = compress_spans(query, spans, token_budget)
+    if packed is None:
+        packed = pack_spans(spans, token_budget)
+
+    raw_tokens = sum(estimate_tokens(chunk['text']) for chunk in chunks)
+    print(f"Assembled {len(chunks)} chunks into {len(packed)} of {len(spans)} spans: "
+          f"{sum(span['tokens'] for span in packed)} tokens (raw chunks {raw_tokens})")
+    return packed
+
+# Identify what the read alias currently serves: its concrete indices and
+# their searchable primary document counts. Ingestion changes the counts once
+# new chunks become visible (replacing a chunk adds a deleted document), and
+# a reindex changes the indices; merges may also change the deleted count,
+# which only costs an unnecessary invalidation.
+def read_index_generation():
+    stats = opensearch.indices.stats(index=index_name, metric='docs')
+    docs = stats['_all']['primaries'].get('docs', {})
+    return f"{','.join(sorted(stats['indices']))}:{docs.get('count', 0)}:{docs.get('deleted', 0)}"
+
+# Answers to recent queries, matched by cosine similarity of the query
+# embeddings with a linear scan over unit vectors held as float32 arrays
+class SemanticAnswerCache:
+    def __init__(self, max_entries, threshold, generation_ttl):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.generation_ttl = generation_ttl
+        self.generation = None
+        self.generation_checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    # Current index generation, dropping every entry when it has advanced.
+    # Returns None, disabling the cache for the request, if it can't be read.
+    def current_generation(self):
+        now = time.time()
+        if self.generation is not None and now - self.generation_checked < self.generation_ttl:
+            return self.generation
+        try:
+            generation = read_index_generation()
+        except Exception as e:
+            print(f"Could not read index generation: {str(e)}")
+            return None
+        with self._lock:
+            if generation != self.generation:
+                if self._entries:
+                    print(f"Index generation advanced to {generation}; dropping {len(self._entries)} cached answers")
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self.generation = generation
+            self.generation_checked = now
+        return generation
+
+    def get(self, embedding, signature, generation):
+        query = unit_vector(embedding)
+        best_key, best_similarity = None, self.threshold
+        with self._lock:
+            if generation != self.generation:
+                return None
+            for key, entry in self._entries.items():
+                if entry['signature'] != signature:
+                    continue
+                similarity = dot(query, entry['vector'])
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            entry = self._entries[best_key]
+            return {'response': entry['response'], 'sources': entry['sources'], 'similarity': best_similarity}
 
-# Generate response using Amazon Bedrock
-def generate_response(query, context_chunks):
+    # Store an answer computed against generation; dropped if the index has
+    # moved on since, or if the embedding is the zero fallback vector
+    def put(self, embedding, signature, generation, response, sources):
+        if not any(embedding):
+            return
+        entry = {
+            'vector': array('f', unit_vector(embedding)),
+            'signature': signature,
+            'response': response,
+            'sources': sources
+        }
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[next(self._ids)] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'invalidations': self.invalidations
+            }
+
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_GENERATION_TTL)
+
+# Answer with the start of the retrieved context when the LLM fails
+def fallback_response(context_chunks):
+    context = "\n\n".join([span['text'] for span in assemble_context(context_chunks)])
+    return f"Based on the available information:\n\n{context[:500]}..."
+
+# Answer given when retrieval found nothing
+NO_CONTEXT_RESPONSE = "I couldn't find any relevant information to answer your question."
+
+# Build the Claude model ID and request body answering query from the chunks
+def build_llm_request(query, context_chunks):
+    # Use Claude 3 Haiku which should be available in your region
+    model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+
+    # Combine context chunks into spans of the sentences that match the query
+    context = "\n\n".join([span['text'] for span in assemble_context(context_chunks, query=query)])
+
+    # Create prompt
+    prompt = f"""
+    Human: I need you to answer a question based on the following context information.
+    Only use information from the provided context to answer the question.
+    If you don't know the answer or can't find it in the context, just say so.
+    Be concise and to the point.
+
+    Do not mention that you're using context information or that your knowledge is limited.
+    Just answer as if you know the information directly.
+
+    Context:
+    {context}
+
+    Question: {query}
+    """
+
+    body = json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 1000,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    })
+    return model_id, body
+
+# Generate response using Amazon Bedrock. With fallback, errors from the LLM
+# are answered by fallback_response instead of raised.
+def generate_response(query, context_chunks, fallback=True):
     try:
         # If no context chunks, return a message
         if not context_chunks:
-            return "I couldn't find any relevant information to answer your question."
-            
-        # Use Claude 3 Haiku which should be available in your region
-        model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-        
-        # Combine context chunks
-        context = "\n\n".join([chunk['text'] for chunk in context_chunks])
-        
-        # Create prompt
-        prompt = f"""
-        Human: I need you to answer a question based on the following context information.
-        Only use information from the provided context to answer the question.
-        If you don't know the answer or can't find it in the context, just say so.
-        Be concise and to the point.
-        
-        Do not mention that you're using context information or that your knowledge is limited.
-        Just answer as if you know the information directly.
-
-        Context:
-        {context}
+            return NO_CONTEXT_RESPONSE
 
-        Question: {query}
-        """
-        
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 1000,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        })
-        
+        model_id, body = build_llm_request(query, context_chunks)
         response = bedrock_runtime.invoke_model(
             modelId=model_id,
             body=body
         )
-        
+
         response_body = json.loads(response['body'].read())
         return response_body['content'][0]['text']
     except Exception as e:
         print(f"Error generating response with LLM: {str(e)}")
+        if not fallback:
+            raise
         # Fallback to simple response
-        return f"Based on the available information:\n\n{context[:500]}..."
+        return fallback_response(context_chunks)
+
+# Yield the answer's text as Claude produces it, using
+# invoke_model_with_response_stream. Errors are raised to the caller.
+def stream_response(query, context_chunks):
+    if not context_chunks:
+        yield NO_CONTEXT_RESPONSE
+        return
 
-# Lambda handler
+    model_id, body = build_llm_request(query, context_chunks)
+    response = bedrock_runtime.invoke_model_with_response_stream(
+        modelId=model_id,
+        body=body
+    )
+    for event in response['body']:
+        if 'chunk' not in event:
+            continue
+        chunk = json.loads(event['chunk']['bytes'])
+        if chunk.get('type') == 'content_block_delta':
+            text = chunk['delta'].get('text')
+            if text:
+                yield text
+
+# Parse and validate the query and retrieval parameters of a request body
+def parse_query_request(body):
+    query = body.get('query')
+    if not query:
+        raise ValueError('No query provided')
+
+    mmr = body.get('mmr', MMR_ENABLED)
+    if not isinstance(mmr, bool):
+        raise ValueError("'mmr' must be true or false")
+    # The Python Lambda runtime can't stream a response body, so streaming is
+    # only offered in-process through stream_answer
+    if body.get('stream'):
+        raise ValueError("Streaming isn't supported by this endpoint; send the request without 'stream'")
+    return {
+        'query': query,
+        'top_k': parse_search_parameter(body, 'top_k', DEFAULT_TOP_K, MAX_TOP_K),
+        'k': parse_search_parameter(body, 'k', None, MAX_TOP_K * 10),
+        'ef_search': parse_ef_search(body),
+        'mode': parse_choice(body, 'mode', SEARCH_MODE, ('knn', 'hybrid')),
+        'fusion': parse_choice(body, 'fusion', FUSION_METHOD, ('rrf', 'weighted')),
+        'weights': parse_fusion_weights(body),
+        'mmr': mmr,
+        'mmr_lambda': parse_fraction(body, 'mmr_lambda', MMR_LAMBDA),
+        'fetch_k': parse_search_parameter(body, 'fetch_k', MMR_FETCH_K, MAX_TOP_K * 10)
+    }
+
+# The retrieval parameters of a request; queries only share answers when they
+# were asked with the same ones
+def retrieval_signature(request):
+    return json.dumps([request[name] for name in (
+        'top_k', 'k', 'ef_search', 'mode', 'fusion', 'weights', 'mmr', 'mmr_lambda', 'fetch_k'
+    )], sort_keys=True)
+
+# Identical requests in flight are coalesced by their normalized query and
+# retrieval parameters
+def query_key(request):
+    return f"{normalize_query(request['query'])}\n{retrieval_signature(request)}"
+
+# Look a query up in the semantic answer cache, which answers it when a
+# near-identical question was asked with the same retrieval parameters since
+# the last ingestion. The returned retrieval carries the cached answer or
+# awaits the query's context chunks.
+def start_retrieval(request, query_embedding):
+    retrieval = {
+        'query_embedding': query_embedding,
+        'embedding_cache': embedding_cache.stats(),
+        'signature': retrieval_signature(request),
+        'generation': answer_cache.current_generation() if ANSWER_CACHE_SIZE > 0 else None,
+        'cached': None,
+        'chunks': []
+    }
+    if retrieval['generation']:
+        retrieval['cached'] = answer_cache.get(query_embedding, retrieval['signature'], retrieval['generation'])
+    if retrieval['cached']:
+        print(f"Answer cache hit (similarity {retrieval['cached']['similarity']:.4f}): {answer_cache.stats()}")
+    return retrieval
+
+# Plan the searches for a retrieval that wasn't answered from the cache
+def plan_retrieval(request, retrieval):
+    return plan_searches(
+        retrieval['query_embedding'], top_k=request['top_k'], k=request['k'], ef_search=request['ef_search'],
+        query_text=request['query'], mode=request['mode'], fusion=request['fusion'], weights=request['weights'],
+        mmr=request['mmr'], mmr_lambda=request['mmr_lambda'], fetch_k=request['fetch_k']
+    )
+
+# Parse a batch request body. Each entry of queries is a query string or an
+# object of query and retrieval parameters overriding those given beside
+# queries for the whole batch.
+def parse_batch_request(body):
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not queries:
+        raise ValueError("'queries' must be a non-empty list")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise ValueError(f"At most {MAX_BATCH_QUERIES} queries can be batched")
+
+    shared = {name: value for name, value in body.items() if name != 'queries'}
+    requests = []
+    for position, query in enumerate(queries):
+        if isinstance(query, str):
+            query = {'query': query}
+        elif not isinstance(query, dict):
+            raise ValueError(f"queries[{position}] must be a string or an object")
+        try:
+            request = parse_query_request({**shared, **query})
+        except ValueError as e:
+            raise ValueError(f"queries[{position}]: {str(e)}")
+        requests.append(request)
+    return requests
+
+# Embed the query, then answer it from the semantic cache or retrieve its
+# context chunks
+def retrieve_for_query(request):
+    print(f"Processing query: {request['query']}")
+
+    # Generate embedding for the normalized query, usually from the cache
+    # on warm containers
+    retrieval = start_retrieval(request, generate_embedding(normalize_query(request['query'])))
+    print(f"Embedding cache: {retrieval['embedding_cache']}")
+    if retrieval['cached']:
+        return retrieval
+
+    # Search for relevant chunks
+    try:
+        plan = plan_retrieval(request, retrieval)
+    except Exception as e:
+        print(f"Search error: {str(e)}")
+        return retrieval
+    retrieval['chunks'] = execute_searches([plan])[0]
+    return retrieval
+
+# Retrieve and answer a query, returning (retrieval, response, sources)
+def answer_query(request):
+    retrieval = retrieve_for_query(request)
+    response, sources = answer_from_retrieval(request, retrieval)
+    return retrieval, response, sources
+
+# Answer a retrieved query, returning (response, sources). Only answers
+# grounded in retrieved chunks are cached; fallbacks after an LLM error are
+# not.
+def answer_from_retrieval(request, retrieval):
+    if retrieval['cached']:
+        return retrieval['cached']['response'], retrieval['cached']['sources']
+
+    sources = [chunk['document_id'] for chunk in retrieval['chunks']]
+    try:
+        response = generate_response(request['query'], retrieval['chunks'], fallback=False)
+        cache_answer(retrieval, response, sources)
+    except Exception:
+        response = fallback_response(retrieval['chunks'])
+    print(f"Generated response (first 100 chars): {response[:100]}")
+    return response, sources
+
+# Cache an answer grounded in retrieved chunks
+def cache_answer(retrieval, response, sources):
+    if retrieval['generation'] and retrieval['chunks']:
+        answer_cache.put(retrieval['query_embedding'], retrieval['signature'], retrieval['generation'], response, sources)
+
+# Embed one batched query, timing it in milliseconds
+def embed_batch_query(request):
+    started = time.time()
+    embedding = generate_embedding(normalize_query(request['query']))
+    return embedding, round((time.time() - started) * 1000)
+
+# Answer one batched query. A failure is reported in its result rather than
+# failing the batch.
+def answer_batch_query(request, retrieval):
+    started = time.time()
+    result = {'query': request['query'], 'cached': retrieval['cached'] is not None}
+    try:
+        result['response'], result['sources'] = answer_from_retrieval(request, retrieval)
+    except Exception as e:
+        print(f"Error answering batched query {request['query']!r}: {str(e)}")
+        result['error'] = str(e)
+    result['generate_ms'] = round((time.time() - started) * 1000)
+    return result
+
+# Answer a batch of requests: the queries are embedded concurrently, those
+# not answered by the semantic cache are searched in one msearch round trip,
+# and answers are generated with bounded parallelism. A query identical to
+# one in flight, in this batch or another request, awaits that answer
+# instead. Returns per-query results in request order with their timing, and
+# the timing of each phase in milliseconds.
+def answer_batch(requests):
+    started = time.time()
+    print(f"Processing batch of {len(requests)} queries")
+    keys = [query_key(request) for request in requests]
+    flights = [query_flights.join(key) for key in keys]
+    leading = [position for position, (_, leader) in enumerate(flights) if leader]
+    leaders = [requests[position] for position in leading]
+    results = [None] * len(requests)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_EMBEDDING_CONCURRENCY, len(leaders)))) as executor:
+            embedded = list(executor.map(embed_batch_query, leaders))
+        retrievals = [start_retrieval(request, embedding) for request, (embedding, _) in zip(leaders, embedded)]
+        embedded_at = time.time()
+
+        # Plans that can't be built (a wrong embedding dimension) leave their
+        # query without chunks, as for a single query
+        planned = []
+        for request, retrieval in zip(leaders, retrievals):
+            if retrieval['cached']:
+                continue
+            try:
+                planned.append((retrieval, plan_retrieval(request, retrieval)))
+            except Exception as e:
+                print(f"Search error: {str(e)}")
+        if planned:
+            for (retrieval, _), chunks in zip(planned, execute_searches([plan for _, plan in planned])):
+                retrieval['chunks'] = chunks
+        searched_at = time.time()
+
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_GENERATION_CONCURRENCY, len(leaders)))) as executor:
+            answered = list(executor.map(answer_batch_query, leaders, retrievals))
+        generated_at = time.time()
+
+        for position, result, retrieval, (_, embed_ms) in zip(leading, answered, retrievals, embedded):
+            result['coalesced'] = False
+            result['timing'] = {'embed_ms': embed_ms, 'generate_ms': result.pop('generate_ms')}
+            results[position] = result
+            future = flights[position][0]
+            if 'error' in result:
+                query_flights.finish(keys[position], future, error=RuntimeError(result['error']))
+            else:
+                query_flights.finish(keys[position], future, (retrieval, result['response'], result['sources']))
+    finally:
+        for position in leading:
+            future = flights[position][0]
+            if not future.done():
+                query_flights.finish(keys[position], future, error=RuntimeError('The batch failed'))
+
+    # Leaders are settled before waiting, so batches sharing queries can't
+    # wait on each other
+    for position, (future, leader) in enumerate(flights):
+        if leader:
+            continue
+        result = {'query': requests[position]['query']}
+        try:
+            retrieval, result['response'], result['sources'] = future.result()
+            result['cached'] = retrieval['cached'] is not None
+        except Exception as e:
+            result['error'] = str(e)
+        result['coalesced'] = True
+        result['timing'] = {'wait_ms': round((time.time() - generated_at) * 1000)}
+        results[position] = result
+    finished = time.time()
+
+    print(f"Answered batch of {len(requests)} queries ({len(requests) - len(leaders)} coalesced, "
+          f"{len(leaders) - len(planned)} without searching) in {(finished - started) * 1000:.0f} ms")
+    return {
+        'results': results,
+        'timing': {
+            'embed_ms': round((embedded_at - started) * 1000),
+            'search_ms': round((searched_at - embedded_at) * 1000),
+            'generate_ms': round((generated_at - searched_at) * 1000),
+            'total_ms': round((finished - started) * 1000)
+        },
+        'embedding_cache': embedding_cache.stats(),
+        'answer_cache': answer_cache.stats(),
+        'coalescing': coalescing_stats()
+    }
+
+# Format one server-sent event
+def sse_event(data, event=None):
+    frame = f"event: {event}\n" if event else ''
+    return f"{frame}data: {json.dumps(data)}\n\n"
+
+# Answer a request as server-sent events: one {"delta": text} event per piece
+# of the answer as Claude produces it, then a "done" event carrying the
+# sources, cache state and timing in milliseconds. For in-process callers
+# that can forward the events as they are produced.
+def stream_answer(request):
+    started = time.time()
+    # Each stream generates its own answer, but identical queries in flight
+    # share one retrieval
+    retrieval, _ = retrieval_flights.do(query_key(request), lambda: retrieve_for_query(request))
+    retrieved = time.time()
+    first_token = None
+    pieces = []
+
+    if retrieval['cached']:
+        sources = retrieval['cached']['sources']
+        pieces.append(retrieval['cached']['response'])
+        first_token = time.time()
+        yield sse_event({'delta': pieces[0]})
+    else:
+        sources = [chunk['document_id'] for chunk in retrieval['chunks']]
+        try:
+            for text in stream_response(request['query'], retrieval['chunks']):
+                if first_token is None:
+                    first_token = time.time()
+                pieces.append(text)
+                yield sse_event({'delta': text})
+            cache_answer(retrieval, ''.join(pieces), sources)
+        except Exception as e:
+            print(f"Error streaming response from LLM: {str(e)}")
+            if pieces:
+                yield sse_event({'message': 'The answer was cut short by an error'}, event='error')
+            else:
+                first_token = time.time()
+                yield sse_event({'delta': fallback_response(retrieval['chunks'])})
+
+    finished = time.time()
+    print(f"Streamed response in {len(pieces)} pieces, {(finished - started) * 1000:.0f} ms")
+    yield sse_event({
+        'sources': sources,
+        'cached': retrieval['cached'] is not None,
+        'timing': {
+            'retrieval_ms': round((retrieved - started) * 1000),
+            'first_token_ms': round(((first_token or finished) - started) * 1000),
+            'total_ms': round((finished - started) * 1000)
+        },
+        'embedding_cache': retrieval['embedding_cache'],
+        'answer_cache': answer_cache.stats(),
+        'coalescing': coalescing_stats()
+    }, event='done')
+
+# Lambda handler. Requests with "queries" instead of "query" are answered by
+# answer_batch.
 def lambda_handler(event, context):
     try:
         print(f"Received event: {json.dumps(event)}")
-        
+
         # Parse request body
         body = json.loads(event.get('body', '{}'))
-        query = body.get('query')
-
-        if not query:
+        try:
+            if 'queries' in body:
+                requests = parse_batch_request(body)
+            else:
+                request = parse_query_request(body)
+        except ValueError as e:
             return {
                 'statusCode': 400,
-                'body': json.dumps('No query provided')
+                'body': json.dumps(str(e))
             }
-            
-        print(f"Processing query: {query}")
 
-        # Generate embedding for the query
-        query_embedding = generate_embedding(query)
-
-        # Search for relevant chunks
-        relevant_chunks = search_documents(query_embedding)
+        if 'queries' in body:
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps(answer_batch(requests))
+            }
 
-        # Generate response using LLM
-        response = generate_response(query, relevant_chunks)
-        print(f"Generated response (first 100 chars): {response[:100]}")
+        # Identical queries in flight share one answer
+        (retrieval, response, sources), coalesced = query_flights.do(query_key(request), lambda: answer_query(request))
+        print(f"Coalescing: {coalescing_stats()}")
 
         return {
             'statusCode': 200,
@@ -204,7 +1447,12 @@ def lambda_handler(event, context):
             },
             'body': json.dumps({
                 'response': response,
-                'sources': [chunk['document_id'] for chunk in relevant_chunks]
+                'sources': sources,
+                'cached': retrieval['cached'] is not None,
+                'coalesced': coalesced,
+                'embedding_cache': retrieval['embedding_cache'],
+                'answer_cache': answer_cache.stats(),
+                'coalescing': coalescing_stats()
             })
         }
 
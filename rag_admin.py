@@ -4,6 +4,8 @@ import boto3
 import os
 import sys
 import json
+import random
+import time
 
 def upload_document(file_path, bucket_name):
    """Upload a document to S3 bucket"""
@@ -54,6 +56,257 @@ def trigger_embedding(document_key, function_name):
        print(f"Error triggering Lambda: {str(e)}")
        return False
 
+def summarize_fan_out(plan, parts):
+   """Print per-range and total results of a fan-out ingestion run; returns
+   False if any page range failed"""
+   indexed = sum(part.get('indexed', 0) for part in parts.values())
+   failed = sum(part.get('failed', 0) for part in parts.values())
+   failed_ranges = [name for name, part in parts.items() if part.get('status') == 'failed']
+   for name in sorted(parts, key=lambda name: int(name.split('-')[0])):
+       if name in failed_ranges:
+           print(f"  pages {name}: failed: {parts[name].get('error')}")
+       else:
+           print(f"  pages {name}: {parts[name].get('indexed', 0)} indexed, {parts[name].get('failed', 0)} failed")
+   print(f"Run {plan['run_id']}: {len(parts)}/{plan['parts']} page ranges, {indexed} chunks indexed, {failed} failed")
+   if failed_ranges:
+       print(f"{len(failed_ranges)} page ranges failed; the run's chunks were removed and the previous version kept")
+   return not failed_ranges
+
+def trigger_fan_out(document_key, function_name, fan_out, timeout=900, poll_interval=5):
+   """Trigger fan-out ingestion and wait for every page-range worker to finish"""
+   lambda_client = boto3.client('lambda')
+   s3 = boto3.client('s3')
+
+   try:
+       if not document_key.startswith('docs/'):
+           document_key = f"docs/{document_key}"
+
+       print(f"Triggering fan-out ingestion of {document_key} across {fan_out} workers")
+       response = lambda_client.invoke(
+           FunctionName=function_name,
+           InvocationType='RequestResponse',
+           Payload=bytes(json.dumps({'key': document_key, 'fan_out': fan_out}), 'utf-8')
+       )
+
+       response_payload = json.loads(response['Payload'].read().decode('utf-8'))
+       if response_payload.get('statusCode') != 202:
+           print(f"Lambda response: {response_payload}")
+           return False
+
+       plan = json.loads(response_payload['body'])
+       print(f"Run {plan['run_id']}: {plan['page_count']} pages split into {plan['parts']} ranges")
+
+       # Workers record one object per finished page range where the
+       # coordinator's tracker says
+       tracker_bucket = plan['tracker']['bucket']
+       prefix = plan['tracker']['prefix']
+       deadline = time.time() + timeout
+       while True:
+           paginator = s3.get_paginator('list_objects_v2')
+           keys = [obj['Key'] for page in paginator.paginate(Bucket=tracker_bucket, Prefix=prefix)
+                   for obj in page.get('Contents', [])]
+           print(f"  {len(keys)}/{plan['parts']} page ranges complete")
+           if len(keys) >= plan['parts']:
+               break
+           if time.time() > deadline:
+               print(f"Timed out after {timeout}s waiting for workers")
+               if plan.get('session'):
+                   print("The run's ingestion session stays open until its last worker finishes; "
+                         "if a worker was lost, it closes when its lease expires, or close it now with: "
+                         "rag_admin.py ingest-session end")
+               return False
+           time.sleep(poll_interval)
+
+       parts = {}
+       for key in keys:
+           body = s3.get_object(Bucket=tracker_bucket, Key=key)['Body'].read()
+           parts[key.rsplit('/', 1)[-1][:-len('.json')]] = json.loads(body)
+       return summarize_fan_out(plan, parts)
+   except Exception as e:
+       print(f"Error running fan-out ingestion: {str(e)}")
+       return False
+
+def run_fan_out_locally(document_key, fan_out, bucket_name):
+   """Run fan-out ingestion in-process: workers run on local threads and
+   record completion in a local directory instead of S3"""
+   os.environ['INGEST_DISPATCH'] = 'local'
+   os.environ['INGEST_TRACKER'] = 'file'
+   os.environ['DOCUMENT_BUCKET'] = bucket_name
+   import lambda_embed
+
+   try:
+       response = lambda_embed.lambda_handler({'key': document_key, 'fan_out': fan_out}, None)
+       if response.get('statusCode') != 202:
+           print(f"Lambda response: {response}")
+           return False
+
+       plan = json.loads(response['body'])
+       parts = lambda_embed.create_ingest_tracker(bucket_name).completed(plan['run_id'])
+       return summarize_fan_out(plan, parts)
+   except Exception as e:
+       print(f"Error running local fan-out ingestion: {str(e)}")
+       return False
+
+def apply_index_template(force=False):
+   """Apply the versioned embeddings index template to OpenSearch"""
+   # lambda_embed owns the index definition and the OpenSearch connection
+   import lambda_embed
+
+   try:
+       lambda_embed.put_index_template(force=force)
+       lambda_embed.create_index_if_not_exists()
+       return True
+   except Exception as e:
+       print(f"Error applying index template: {str(e)}")
+       return False
+
+def begin_ingestion_session():
+   """Suspend refresh and replicas on the index ahead of a large load.
+   Returns True only if this call opened the session."""
+   import lambda_embed
+
+   try:
+       lambda_embed.create_index_if_not_exists()
+       return lambda_embed.begin_ingestion_session()
+   except Exception as e:
+       print(f"Error opening ingestion session: {str(e)}")
+       return False
+
+def end_ingestion_session(force_merge_segments=None, warmup=True):
+   """Restore the index settings saved by the open ingestion session,
+   optionally force-merge, and warm the kNN graphs"""
+   import lambda_embed
+
+   try:
+       return lambda_embed.end_ingestion_session(force_merge_segments=force_merge_segments, warmup=warmup) is not None
+   except Exception as e:
+       print(f"Error closing ingestion session: {str(e)}")
+       return False
+
+def swap_alias(target_index, replace_legacy=False, delete_old=False):
+   """Atomically point the read and write aliases at target_index"""
+   import lambda_embed
+
+   try:
+       previous = lambda_embed.swap_aliases(target_index, replace_legacy)
+       for old_index in previous:
+           # A legacy index holding the alias name was removed by the swap
+           if old_index in (target_index, lambda_embed.index_name):
+               continue
+           if delete_old:
+               lambda_embed.opensearch.indices.delete(index=old_index)
+               print(f"Deleted {old_index}")
+           else:
+               print(f"Kept {old_index}; swap back with: rag_admin.py swap-alias {old_index}")
+       return True
+   except Exception as e:
+       print(f"Error swapping aliases: {str(e)}")
+       return False
+
+def reindex(reembed=False, dimension=None, slices=None, force_merge_segments=None,
+            swap=True, force=False, replace_legacy=False, delete_old=False):
+   """Build the next versioned index from the live one, validate its document
+   count and atomically move the read and write aliases onto it"""
+   # lambda_embed reads its dimension setting at import time
+   if dimension:
+       os.environ['EMBEDDING_DIMENSION'] = str(dimension)
+   import lambda_embed
+
+   try:
+       live = lambda_embed.resolve_index(lambda_embed.index_name)
+       if not live:
+           print(f"No index behind {lambda_embed.index_name}; run apply-template first")
+           return False
+       source_index = live[-1]
+       if swap and source_index == lambda_embed.index_name and not replace_legacy:
+           print(f"{source_index} is an index, not an alias. Pass --replace-legacy-index to delete it "
+                 f"when the aliases move to the new index.")
+           return False
+
+       target_index = lambda_embed.create_versioned_index()
+       print(f"Building {target_index} from {source_index} by {'re-embedding' if reembed else 'copying'}")
+       with lambda_embed.ingestion_session(index=target_index, force_merge_segments=force_merge_segments):
+           if reembed:
+               result = lambda_embed.reembed_index(source_index, target_index)
+           else:
+               result = lambda_embed.copy_index(source_index, target_index, slices)
+
+       lambda_embed.opensearch.indices.refresh(index=target_index)
+       source_count = lambda_embed.opensearch.count(index=source_index)['count']
+       target_count = lambda_embed.opensearch.count(index=target_index)['count']
+       print(f"Source documents: {source_count}, target documents: {target_count}, failed: {result['failed']}")
+       if (source_count != target_count or result['failed']) and not force:
+           # Chunks written to the source during the build also show up here
+           print(f"Validation failed; aliases still point at {source_index}. "
+                 f"Inspect or delete {target_index}, or re-run with --force")
+           return False
+
+       if not swap:
+           print(f"Built {target_index}; make it live with: rag_admin.py swap-alias {target_index}")
+           return True
+       return swap_alias(target_index, replace_legacy, delete_old)
+   except Exception as e:
+       print(f"Error reindexing: {str(e)}")
+       return False
+
+def migrate_dimension(dimension):
+   """Re-embed every chunk of the live index into a new versioned index whose
+   vectors use the given native dimension"""
+   if not reindex(reembed=True, dimension=dimension, swap=False):
+       return False
+   # Query embeddings must match the dimension of the index behind the alias
+   print(f"Set EMBEDDING_DIMENSION={dimension} on both Lambda functions together with the swap")
+   return True
+
+def seed_query_cache(queries_path, output_path):
+   """Embed a list of popular queries, one per line, into a snapshot that
+   seeds the query Lambda's embedding cache at cold start"""
+   os.environ['EMBEDDING_CACHE_BACKEND'] = 'memory'
+   os.environ.pop('EMBEDDING_CACHE_SNAPSHOT', None)
+   import lambda_query
+
+   try:
+       with open(queries_path) as f:
+           queries = {lambda_query.normalize_query(line) for line in f if line.strip()}
+       # Entries get a fresh TTL when the Lambda loads the snapshot
+       lambda_query.embedding_cache.stores[0].ttl = None
+       for query in sorted(queries):
+           lambda_query.generate_embedding(query)
+       count = lambda_query.embedding_cache.save_snapshot(output_path)
+       print(f"Wrote {count} query embeddings to {output_path}")
+       print("Package the file with the query Lambda and set EMBEDDING_CACHE_SNAPSHOT to its path")
+       return True
+   except Exception as e:
+       print(f"Error seeding query cache: {str(e)}")
+       return False
+
+def check_chunking(file_path=None, words=5000, insert_at=5, min_kept=0.75, seed=7):
+   """Chunk a document, insert one word near its top and report how many
+   content-addressed chunk IDs survive; incremental re-indexing re-embeds
+   only the chunks whose IDs changed"""
+   import lambda_embed
+
+   if file_path:
+       with open(file_path, encoding='utf-8') as f:
+           original = f.read().split()
+   else:
+       rng = random.Random(seed)
+       vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+                     for _ in range(3000)]
+       original = [rng.choice(vocabulary) for _ in range(words)]
+   edited = original[:insert_at] + ['inserted'] + original[insert_at:]
+
+   before = [chunk_id for _, chunk_id, _ in lambda_embed.content_chunk_ids('check', lambda_embed.iter_chunks(original))]
+   after = {chunk_id for _, chunk_id, _ in lambda_embed.content_chunk_ids('check', lambda_embed.iter_chunks(edited))}
+   kept = sum(1 for chunk_id in before if chunk_id in after)
+   ratio = kept / len(before) if before else 1.0
+   print(f"{len(original)} words in {len(before)} chunks; inserting a word at {insert_at} "
+         f"kept {kept} chunk IDs ({ratio:.0%}), {len(after) - kept} chunks would be re-embedded")
+   if ratio < min_kept:
+       print(f"Fewer than {min_kept:.0%} of chunk IDs survived the edit")
+       return False
+   return True
+
 def main():
    parser = argparse.ArgumentParser(description='RAG Admin CLI')
    subparsers = parser.add_subparsers(dest='command', help='Commands')
@@ -67,6 +320,66 @@ def main():
    process_parser = subparsers.add_parser('process', help='Process a document')
    process_parser.add_argument('key', help='S3 key of the document')
    process_parser.add_argument('--function', default='lambda_embed', help='Lambda function name')
+   process_parser.add_argument('--fan-out', type=int, default=0,
+                               help='Split the PDF into N page ranges processed by parallel worker invocations')
+   process_parser.add_argument('--bucket', default='rag-document-store-ninad-test', help='S3 bucket name')
+   process_parser.add_argument('--timeout', type=int, default=900, help='Seconds to wait for fan-out workers')
+   process_parser.add_argument('--local', action='store_true',
+                               help='Run the fan-out coordinator and workers in-process instead of on Lambda')
+   process_parser.add_argument('--session', action='store_true',
+                               help='Suspend refresh and replicas while processing, then restore them and warm the kNN graphs '
+                                    '(fan-out runs always do this)')
+
+   # Ingestion session command
+   session_parser = subparsers.add_parser('ingest-session', help='Open or close an ingestion session on the index')
+   session_parser.add_argument('action', choices=['begin', 'end'], help='Suspend or restore refresh and replicas')
+   session_parser.add_argument('--force-merge', type=int, metavar='SEGMENTS',
+                               help='On end, force-merge to this many segments per shard (default: INGEST_FORCE_MERGE_SEGMENTS)')
+   session_parser.add_argument('--no-warmup', action='store_true', help='On end, skip the kNN graph warmup')
+
+   # Index template command
+   template_parser = subparsers.add_parser('apply-template', help='Apply the versioned index template and create the index')
+   template_parser.add_argument('--force', action='store_true', help='Re-apply even if the cluster has this version')
+
+   # Reindex command
+   reindex_parser = subparsers.add_parser('reindex', help='Rebuild the live index as a new version and swap the aliases')
+   reindex_parser.add_argument('--reembed', action='store_true',
+                               help='Re-embed every chunk instead of copying the stored vectors')
+   reindex_parser.add_argument('--dimension', type=int, choices=[256, 512, 1024],
+                               help='Titan v2 output dimension for the new index (requires --reembed)')
+   reindex_parser.add_argument('--slices', type=int, help='Parallel scroll slices when copying (default: REINDEX_SLICES)')
+   reindex_parser.add_argument('--force-merge', type=int, metavar='SEGMENTS',
+                               help='Force-merge the new index to this many segments per shard before the swap')
+   reindex_parser.add_argument('--no-swap', action='store_true', help='Build and validate the new index without swapping')
+   reindex_parser.add_argument('--force', action='store_true', help='Swap even if document counts differ')
+   reindex_parser.add_argument('--replace-legacy-index', action='store_true',
+                               help='Delete a pre-alias index named like the read alias when swapping')
+   reindex_parser.add_argument('--delete-old', action='store_true', help='Delete the previous version after the swap')
+
+   # Alias swap command
+   swap_parser = subparsers.add_parser('swap-alias', help='Point the read and write aliases at an index')
+   swap_parser.add_argument('index', help='Versioned index to make live')
+   swap_parser.add_argument('--replace-legacy-index', action='store_true',
+                            help='Delete a pre-alias index named like the read alias')
+   swap_parser.add_argument('--delete-old', action='store_true', help='Delete the previous version after the swap')
+
+   # Dimension migration command
+   migrate_parser = subparsers.add_parser('migrate-dimension', help='Re-embed the live index at a new vector dimension')
+   migrate_parser.add_argument('--dimension', type=int, choices=[256, 512, 1024], default=1024,
+                               help='Titan v2 output dimension for the new index')
+
+   # Query cache snapshot command
+   seed_parser = subparsers.add_parser('seed-query-cache', help='Build a query embedding cache snapshot')
+   seed_parser.add_argument('queries', help='Text file with one query per line')
+   seed_parser.add_argument('--output', default='query_cache_snapshot.jsonl', help='Snapshot file to write')
+
+   # Chunking stability check
+   chunking_parser = subparsers.add_parser('check-chunking',
+                                           help='Check that a small edit near the top keeps most chunk IDs')
+   chunking_parser.add_argument('--file', help='Text file to chunk (default: synthetic text)')
+   chunking_parser.add_argument('--words', type=int, default=5000, help='Words of synthetic text')
+   chunking_parser.add_argument('--insert-at', type=int, default=5, help='Word position of the inserted word')
+   chunking_parser.add_argument('--min-kept', type=float, default=0.75, help='Share of chunk IDs that must survive')
 
    # Parse arguments
    args = parser.parse_args()
@@ -74,7 +387,40 @@ def main():
    if args.command == 'upload':
        upload_document(args.file, args.bucket)
    elif args.command == 'process':
-       trigger_embedding(args.key, args.function)
+       if args.fan_out and args.local:
+           run_fan_out_locally(args.key, args.fan_out, args.bucket)
+       elif args.fan_out:
+           trigger_fan_out(args.key, args.function, args.fan_out, args.timeout)
+       elif args.session:
+           opened = begin_ingestion_session()
+           try:
+               trigger_embedding(args.key, args.function)
+           finally:
+               if opened:
+                   end_ingestion_session()
+       else:
+           trigger_embedding(args.key, args.function)
+   elif args.command == 'ingest-session':
+       if args.action == 'begin':
+           begin_ingestion_session()
+       else:
+           end_ingestion_session(args.force_merge, not args.no_warmup)
+   elif args.command == 'reindex':
+       if args.dimension and not args.reembed:
+           parser.error('--dimension requires --reembed')
+       reindex(args.reembed, args.dimension, args.slices, args.force_merge,
+               not args.no_swap, args.force, args.replace_legacy_index, args.delete_old)
+   elif args.command == 'swap-alias':
+       swap_alias(args.index, args.replace_legacy_index, args.delete_old)
+   elif args.command == 'migrate-dimension':
+       migrate_dimension(args.dimension)
+   elif args.command == 'seed-query-cache':
+       seed_query_cache(args.queries, args.output)
+   elif args.command == 'check-chunking':
+       if not check_chunking(args.file, args.words, args.insert_at, args.min_kept):
+           sys.exit(1)
+   elif args.command == 'apply-template':
+       apply_index_template(args.force)
    else:
        parser.print_help()
 
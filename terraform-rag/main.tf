@@ -82,6 +82,7 @@ module "lambda" {
   lambda_query_role_arn    = module.iam.lambda_query_role_arn
   opensearch_endpoint      = module.opensearch.domain_endpoint
   s3_bucket_arn            = aws_s3_bucket.document_bucket.arn
+  s3_bucket_name           = aws_s3_bucket.document_bucket.id
   api_gateway_execution_arn = aws_api_gateway_rest_api.rag_api.execution_arn
   embeddings_model         = var.ml_model_conf.embeddings_model
   query_model              = var.ml_model_conf.query_model
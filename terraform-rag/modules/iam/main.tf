@@ -185,6 +185,31 @@ resource "aws_iam_policy" "opensearch_access" {
   })
 }
 
+# Lambda Invoke Policy (fan-out ingestion workers)
+resource "aws_iam_policy" "lambda_invoke" {
+  name        = "lambda-invoke-policy-${var.environment}"
+  description = "Policy for invoking Lambda functions"
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action = [
+          "lambda:InvokeFunction"
+        ]
+        Effect   = "Allow"
+        Resource = "*"
+      }
+    ]
+  })
+
+  tags = merge(var.common_tags, {
+    Name        = "lambda-invoke-policy-${var.environment}"
+    Environment = var.environment
+    Project     = var.project_name
+  })
+}
+
 # Attach policies to Lambda Embed Role
 resource "aws_iam_role_policy_attachment" "embed_basic_execution" {
   role       = aws_iam_role.lambda_embed_role.name
@@ -211,6 +236,11 @@ resource "aws_iam_role_policy_attachment" "embed_opensearch_access" {
   policy_arn = aws_iam_policy.opensearch_access.arn
 }
 
+resource "aws_iam_role_policy_attachment" "embed_lambda_invoke" {
+  role       = aws_iam_role.lambda_embed_role.name
+  policy_arn = aws_iam_policy.lambda_invoke.arn
+}
+
 # Attach policies to Lambda Query Role
 resource "aws_iam_role_policy_attachment" "query_basic_execution" {
   role       = aws_iam_role.lambda_query_role.name
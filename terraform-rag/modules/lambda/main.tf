@@ -25,6 +25,7 @@ resource "aws_lambda_function" "lambda_embed" {
       OPENSEARCH_ENDPOINT = var.opensearch_endpoint
       EMBEDDINGS_MODEL    = var.embeddings_model
       REGION              = var.region
+      DOCUMENT_BUCKET     = var.s3_bucket_name
     }
   }
 
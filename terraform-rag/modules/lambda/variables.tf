@@ -38,6 +38,11 @@ variable "s3_bucket_arn" {
   type        = string
 }
 
+variable "s3_bucket_name" {
+  description = "Name of the S3 bucket for document storage"
+  type        = string
+}
+
 variable "api_gateway_execution_arn" {
   description = "Execution ARN of the API Gateway"
   type        = string
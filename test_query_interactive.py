@@ -43,13 +43,70 @@ def query_rag_system(query_text):
     except Exception as e:
         print(f"Error querying RAG system: {str(e)}")
 
+def iter_sse_events(lines):
+    """
+    Parse server-sent event lines into (event, data) pairs
+    """
+    event, data = 'message', []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads('\n'.join(data))
+            event, data = 'message', []
+        elif line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].strip())
+    if data:
+        yield event, json.loads('\n'.join(data))
+
+def print_streamed_answer(events):
+    """
+    Print answer deltas as they arrive, then the sources and timing
+    """
+    print("\n" + "="*80)
+    print("QUERY RESPONSE:")
+    print("="*80)
+    for event, data in events:
+        if event == 'done':
+            print("\n" + "-"*80)
+            print("SOURCES:")
+            for source in data.get('sources', []):
+                print(f"- {source}")
+            timing = data.get('timing', {})
+            print(f"\nFirst token: {timing.get('first_token_ms')} ms, total: {timing.get('total_ms')} ms"
+                  f"{' (cached answer)' if data.get('cached') else ''}")
+            print("="*80 + "\n")
+        elif event == 'error':
+            print(f"\n[{data.get('message')}]")
+        else:
+            print(data.get('delta', ''), end='', flush=True)
+
+def query_rag_system_local(query_text):
+    """
+    Run the query pipeline in-process, printing the answer token by token
+    as Bedrock streams it (needs the query Lambda's environment variables)
+    """
+    import lambda_query
+
+    try:
+        request = lambda_query.parse_query_request({'query': query_text})
+        events = (event for frame in lambda_query.stream_answer(request)
+                  for event in iter_sse_events(frame.split('\n')))
+        print_streamed_answer(events)
+    except Exception as e:
+        print(f"Error querying RAG system: {str(e)}")
+
 def main():
     parser = argparse.ArgumentParser(description='Query the RAG system')
     parser.add_argument('--query', '-q', help='Query text (optional)')
+    parser.add_argument('--local', action='store_true',
+                        help='Run the query pipeline in-process and print the answer as it streams')
     args = parser.parse_args()
+    query_fn = query_rag_system_local if args.local else query_rag_system
     
     if args.query:
-        query_rag_system(args.query)
+        query_fn(args.query)
     else:
         print("Interactive RAG Query System")
         print("Type 'exit' or 'quit' to end the session")
@@ -59,7 +116,7 @@ def main():
             if query.lower() in ['exit', 'quit']:
                 break
             
-            query_rag_system(query)
+            query_fn(query)
 
 if __name__ == '__main__':
     main()
@@ -16,6 +16,7 @@ class RAGTester:
     def __init__(self, region='us-east-1'):
         self.region = region
         self.bedrock_runtime = boto3.client('bedrock-runtime', region_name=region)
+        self.embedding_dimension = int(os.environ.get('EMBEDDING_DIMENSION', '1024'))
         
         # OpenSearch configuration
         self.host = os.environ.get('OPENSEARCH_ENDPOINT')
@@ -23,7 +24,7 @@ class RAGTester:
             print("Warning: OPENSEARCH_ENDPOINT environment variable not set")
             return
             
-        self.index_name = 'document_embeddings'
+        self.index_name = os.environ.get('INDEX_NAME', 'document_embeddings')
         credentials = boto3.Session().get_credentials()
         awsauth = AWS4Auth(credentials.access_key, credentials.secret_key,
                           region, 'es', session_token=credentials.token)
@@ -47,7 +48,8 @@ class RAGTester:
             if self.opensearch.indices.exists(index=self.index_name):
                 # Get index stats
                 stats = self.opensearch.indices.stats(index=self.index_name)
-                doc_count = stats['indices'][self.index_name]['total']['docs']['count']
+                # INDEX_NAME may be an alias, so read the aggregate over its indices
+                doc_count = stats['_all']['total']['docs']['count']
                 print(f"✅ Index '{self.index_name}' exists with {doc_count} documents")
                 
                 # Sample a few documents
@@ -74,8 +76,12 @@ class RAGTester:
 
     def generate_embedding(self, text):
         """Generate embedding for text"""
-        model_id = "amazon.titan-embed-text-v1"
-        body = json.dumps({"inputText": text})
+        model_id = "amazon.titan-embed-text-v2:0"
+        body = json.dumps({
+            "inputText": text,
+            "dimensions": self.embedding_dimension,
+            "normalize": True
+        })
 
         response = self.bedrock_runtime.invoke_model(
             modelId=model_id,
@@ -182,10 +188,32 @@ class RAGTester:
             "Explain deep learning algorithms"
         ]
         
-        print("\n🧪 Testing different query types:")
-        for query in test_queries:
-            print(f"\n--- Testing: '{query}' ---")
-            self.test_lambda_query(query, lambda_function_name)
+        print("\n🧪 Testing different query types in one batch:")
+        try:
+            lambda_client = boto3.client('lambda')
+            response = lambda_client.invoke(
+                FunctionName=lambda_function_name,
+                InvocationType='RequestResponse',
+                Payload=json.dumps({'body': json.dumps({'queries': test_queries})})
+            )
+
+            response_payload = json.loads(response['Payload'].read().decode('utf-8'))
+            if response_payload.get('statusCode') != 200:
+                print(f"❌ Lambda error: {response_payload}")
+                return
+
+            body = json.loads(response_payload['body'])
+            for result in body['results']:
+                print(f"\n--- Testing: '{result['query']}' ---")
+                if 'error' in result:
+                    print(f"❌ Query failed: {result['error']}")
+                    continue
+                print(f"   Response: {result['response']}")
+                print(f"   Sources: {result['sources']}")
+                print(f"   Timing: {result['timing']}")
+            print(f"\n⏱️  Batch timing: {body['timing']}")
+        except Exception as e:
+            print(f"❌ Batch query test failed: {str(e)}")
 
     def analyze_document_distribution(self):
         """Analyze how documents are distributed in the index"""